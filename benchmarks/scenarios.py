@@ -0,0 +1,308 @@
+# runs fixed scenarios with scripted input and reports update/draw times and allocations per frame
+# usage: python benchmarks/scenarios.py [--frames N] [--scenario NAME ...] [--output FILE]
+#        [--compare FILE] [--no-alloc] [--list]
+
+import os, sys, time, json, math, random, platform, subprocess, tempfile, tracemalloc
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # assets are loaded relative to the repo
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+from lib import *
+from lib_glitchlands import *
+from lib_glitchlands import objects
+import glitchlands
+
+# each scenario is a setup function and an input script of (held inputs, steps) pairs,
+# the script is repeated until the scenario has run for the requested number of frames
+
+
+def script_frames(script, frames):
+    out = []
+    while len(out) < frames:
+        for held, steps in script:
+            mask = 0
+            for i, name in enumerate(Input.keys):
+                if name in held:
+                    mask |= 1 << i
+            if held & {"primary", "secondary", "start", "x", "y", "select", "escape", "reset"}:
+                mask |= 1 << Input.keys.index("any_button")
+            if held & {"left", "right", "up", "down"}:
+                mask |= 1 << Input.keys.index("any_direction")
+            jx = ("right" in held) - ("left" in held)
+            jy = ("up" in held) - ("down" in held)
+            r = Input.joystick_radius
+            out.append(
+                [
+                    mask,
+                    jx * r,
+                    jy * r,
+                    r if jx != 0 or jy != 0 else 0,
+                    math.degrees(math.atan2(jy, jx)),
+                    steps,
+                ]
+            )
+    return out
+
+
+def enter_level(gc, pos, **cp):
+    if not cp:
+        cp = {"centerx": gc.game_width // 2, "top": 0}
+    gc.player.abilities.set_all(True)
+    gc.checkpoint = Checkpoint(pos, **cp)
+    gc.restore_checkpoint(initial=True)
+
+
+def setup_level(pos, **cp):
+    return lambda gc: enter_level(gc, pos, **cp)
+
+
+def setup_virus(attack):
+    def setup(gc):
+        enter_level(gc, (0, 8, 0), centerx=gc.game_width // 2, bottom=gc.game_height - 64)
+        boss = next(obj for obj in gc.get_all_objects() if isinstance(obj, objects.VirusBoss))
+        boss.attack_count = min(boss.level_order)  # level attacks need a chunk to build
+        if attack != boss.ATTACK_PRE_LEVEL:  # repeat it, so each attack is measured on its own
+            boss.next_attack = lambda: boss.set_attack(attack)
+        boss.set_attack(attack)
+
+    return setup
+
+
+def setup_map(gc):
+    enter_level(gc, (1, 0, 0))
+    canvas = MapCanvas(gc)
+    canvas.build()
+    gc.visited_levels |= set(canvas.tiles)  # everything revealed, the most expensive map to draw
+    gc.map_canvas = MapCanvas(gc)
+    gc.enable_pause(MENU_MAP)
+
+
+def setup_credits(gc):
+    gc.in_game = False
+    gc.level = None
+    gc.set_menu(MENU_CREDITS, SUBMENU_SKIP_CREDITS)
+
+
+WALK = [
+    ({"right"}, 60),
+    ({"right", "primary"}, 20),
+    ({"right"}, 40),
+    ({"left"}, 60),
+    ({"left", "primary"}, 20),
+    ({"secondary"}, 10),
+    (set(), 30),
+]
+IDLE = [({"secondary"}, 4), (set(), 56), ({"left"}, 30), ({"right"}, 30)]
+PAN = [({"right"}, 90), ({"down"}, 60), ({"left"}, 90), ({"up"}, 60), ({"right", "primary"}, 60)]
+
+SCENARIOS = {
+    "world1_dense": (setup_level((1, -2, 3), left=416, bottom=448), WALK),
+    "glitch_zones": (setup_level((2, -1, -3)), WALK),
+    "objects_dense": (setup_level((2, -4, 2)), WALK),
+    "bats": (setup_level((3, 5, 4)), WALK),
+    "map_menu": (setup_map, PAN),
+    "credits": (setup_credits, [(set(), 60)]),
+}
+for name, attack in (
+    ("intro", objects.VirusBoss.ATTACK_INTRO),
+    ("level", objects.VirusBoss.ATTACK_PRE_LEVEL),
+    ("red_glitch_horizontal", objects.VirusBoss.ATTACK_RED_GLITCH_HORIZONTAL),
+    ("red_glitch_vertical", objects.VirusBoss.ATTACK_RED_GLITCH_VERTICAL),
+    ("blue_glitch_horizontal", objects.VirusBoss.ATTACK_BLUE_GLITCH_HORIZONTAL),
+    ("blue_glitch_vertical", objects.VirusBoss.ATTACK_BLUE_GLITCH_VERTICAL),
+    ("green_glitch_horizontal", objects.VirusBoss.ATTACK_GREEN_GLITCH_HORIZONTAL),
+    ("green_glitch_vertical", objects.VirusBoss.ATTACK_GREEN_GLITCH_VERTICAL),
+    ("spikes", objects.VirusBoss.ATTACK_SPIKES),
+    ("saws", objects.VirusBoss.ATTACK_SAWS),
+    ("bats", objects.VirusBoss.ATTACK_BATS),
+):
+    SCENARIOS["virus_" + name] = (setup_virus(attack), IDLE)
+
+
+def start(gc, name, frames, seed):
+    setup, script = SCENARIOS[name]
+    random.seed(seed)
+    gc.init_level()
+    setup(gc)
+    InputRecording.start_replay_data(
+        {"seed": seed, "keys": Input.keys, "frames": script_frames(script, frames)}
+    )
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def traced(func):  # peak python memory above the starting point, and blocks left allocated
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    before = sys.getallocatedblocks()
+    func()
+    return (tracemalloc.get_traced_memory()[1] - current) / 1024, sys.getallocatedblocks() - before
+
+
+def present(gc):
+    gc.draw()
+    gc.draw_overlays()
+    gc.main_surface.blit(gc.screen, (0, 0))
+    pygame.display.update()
+
+
+def frame(gc, measure):  # one step and one draw, like an iteration of mainloop
+    update = measure(gc.step)
+    state = random.getstate()
+    drawn = measure(lambda: present(gc))
+    random.setstate(state)
+    gc.clock.tick()
+    return update, drawn
+
+
+def run_timing(gc, name, frames, warmup, seed):
+    start(gc, name, frames + warmup, seed)
+    update, drawn = [], []
+    counts = dict(gc.particle_counts)
+    particles = {"peak": 0}
+    for i in range(frames + warmup):
+        u, d = frame(gc, timed)
+        particles["peak"] = max(particles["peak"], len(gc.particles))
+        if i >= warmup:
+            update.append(u)
+            drawn.append(d)
+    for key, value in gc.particle_counts.items():
+        particles[key] = value - counts[key]
+    return update, drawn, particles
+
+
+def run_alloc(gc, name, frames, warmup, seed):
+    # separate pass, tracemalloc slows everything down. only python allocations are seen,
+    # pixel data owned by SDL is not
+    start(gc, name, frames + warmup, seed)
+    for _ in range(warmup):
+        frame(gc, timed)
+    peak, blocks = [], []
+    tracemalloc.start()
+    for _ in range(frames):
+        u, d = frame(gc, traced)
+        peak.append(u[0] + d[0])
+        blocks.append(u[1] + d[1])
+    tracemalloc.stop()
+    return peak, blocks
+
+
+def summarize(values):
+    s = sorted(values)
+
+    def pct(p):
+        return s[min(len(s) - 1, int(math.ceil(p / 100 * len(s))) - 1)]
+
+    return {
+        "mean": round(sum(s) / len(s), 4),
+        "p50": round(pct(50), 4),
+        "p95": round(pct(95), 4),
+        "p99": round(pct(99), 4),
+        "max": round(s[-1], 4),
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT
+        )
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            cwd=ROOT,
+        )
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "") or None
+    except OSError:
+        return None
+
+
+def print_table(report, baseline=None):
+    columns = ("update_ms", "draw_ms", "alloc_kib", "alloc_blocks")
+    print(f"{'scenario':<30}" + "".join(f"{c + ' mean/p95/p99':>30}" for c in columns))
+    for name, result in report["scenarios"].items():
+        line = f"{name:<30}"
+        for c in columns:
+            if c not in result:
+                line += f"{'-':>30}"
+                continue
+            r = result[c]
+            cell = f"{r['mean']:.2f}/{r['p95']:.2f}/{r['p99']:.2f}"
+            old = (baseline or {}).get("scenarios", {}).get(name, {}).get(c)
+            if old and old["mean"]:
+                cell += f" ({(r['mean'] / old['mean'] - 1) * 100:+.0f}%)"
+            line += f"{cell:>30}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--frames", type=int, default=600, help="measured frames per scenario")
+    parser.add_argument("--warmup", type=int, default=60, help="unmeasured frames per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), metavar="NAME")
+    parser.add_argument("--output", help="write the report as json")
+    parser.add_argument("--compare", help="previous json report to compare means against")
+    parser.add_argument("--no-alloc", action="store_true", help="skip the allocation pass")
+    parser.add_argument("--list", action="store_true", help="list scenarios and exit")
+    args = parser.parse_args()
+    if args.list:
+        print("\n".join(SCENARIOS))
+        sys.exit()
+
+    glitchlands.GameController.enable_headless()
+    pygame.init()
+    gc = glitchlands.GameController()
+    gc.save_base = tempfile.mkdtemp()  # never touch real saves
+    gc.init()
+    gc.save_slot = -1
+    gc.clock = pygame.time.Clock()
+    gc.dt = 1 / gc.tick_rate
+    gc.running = True
+
+    report = {
+        "version": 1,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "frames": args.frames,
+        "warmup": args.warmup,
+        "seed": args.seed,
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        update, draw, particles = run_timing(gc, name, args.frames, args.warmup, args.seed)
+        result = {
+            "update_ms": summarize(update),
+            "draw_ms": summarize(draw),
+            "particles": particles,
+        }
+        if not args.no_alloc:
+            peak, blocks = run_alloc(gc, name, args.frames, args.warmup, args.seed)
+            result["alloc_kib"] = summarize(peak)
+            result["alloc_blocks"] = summarize(blocks)
+        report["scenarios"][name] = result
+        print(f"{name}: done", file=sys.stderr)
+    InputRecording.stop()
+    Input.stop()
+    pygame.quit()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,80 @@
+# compares AssetLoader.shield_static with the per-pixel loop it replaced
+# usage: python benchmarks/shield_static.py [--copies N] [--repeat N] [--scale N]
+
+import os, sys, time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # assets are loaded relative to the repo
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import random
+import pygame
+from lib import *
+from glitchlands import AssetLoader
+
+
+def shield_static_loop(sheet, copies=1, min_alpha=0, max_alpha=128):
+    out = Spritesheet(
+        sheet.width * copies, sheet.height * copies, hflip=sheet.hflip, vflip=sheet.vflip
+    )
+    for frame in sheet.sprites:
+        for _ in range(copies):
+            surface = frame.copy()
+            for x in range(0, surface.get_width(), 2):
+                for y in range(0, surface.get_height(), 2):
+                    if surface.get_at((x, y)) == (69, 69, 69, 255):
+                        pygame.draw.rect(
+                            surface,
+                            (255, 255, 255, random.randint(min_alpha, max_alpha)),
+                            (x, y, 2, 2),
+                        )
+            out.add(surface)
+    return out
+
+
+def best_of(repeat, func, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def same_pixels(a, b, min_alpha, max_alpha):  # alpha of the static is random, only check its range
+    for fa, fb in zip(a.sprites, b.sprites):
+        for x in range(fa.get_width()):
+            for y in range(fa.get_height()):
+                ca, cb = fa.get_at((x, y)), fb.get_at((x, y))
+                if ca[:3] != cb[:3]:
+                    return False
+                if ca[:3] == (255, 255, 255) and ca != cb:
+                    if not (min_alpha <= ca[3] <= max_alpha and min_alpha <= cb[3] <= max_alpha):
+                        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--copies", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=2, help="destination scale of the sprites")
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    assets = AssetLoader()
+    sheet = Assets.load_spritesheet(
+        "objects/shield_pedestal.png", (16, 16), (16 * args.scale, 16 * args.scale)
+    )
+    loop_time, loop_out = best_of(args.repeat, shield_static_loop, sheet, args.copies)
+    array_time, array_out = best_of(args.repeat, assets.shield_static, sheet, args.copies, seed=0)
+    pixels = sum(f.get_width() * f.get_height() for f in array_out.sprites)
+    print(f"{len(array_out)} frames, {pixels} pixels (best of {args.repeat})")
+    print(f"loop:       {loop_time*1000:9.2f} ms")
+    print(f"surfarray:  {array_time*1000:9.2f} ms  ({loop_time/array_time:.1f}x)")
+    print("output matches:", same_pixels(loop_out, array_out, 0, 128))
@@ -1,4 +1,5 @@
-import os, time, json, random, shutil, webbrowser
+import sys, os, time, json, random, shutil, threading, weakref, webbrowser
+from importlib.util import find_spec
 from functools import cmp_to_key
 from argparse import ArgumentParser
 
@@ -8,17 +9,50 @@ from lib_glitchlands import player, objects, ui, particles
 
 import pygame
 
-pygame.mixer.pre_init(44100, -16, 2, 1024)
-pygame.init()
-try:
-    from PygameShader import shader
-except ImportError:
-    shader = None
+if any(arg.split("=")[0] == "--trace-startup" for arg in sys.argv[1:]):
+    StartupTrace.enable()  # enabled before argument parsing so pygame.init is traced too
+if "--headless" in sys.argv[1:]:
+    GameControllerBase.enable_headless()  # the dummy drivers have to be selected before pygame.init
+
+with StartupTrace.span("pygame.init"):
+    pygame.mixer.pre_init(44100, -16, 2, 1024)
+    pygame.init()
+
+
+class ShaderLoader:  # PygameShader pulls in numpy, so it is only imported once shaders are enabled
+    module = None
+    available = find_spec("PygameShader") is not None
+    loading = False
+
+    @staticmethod
+    def load(sync=True):
+        def thread():
+            with StartupTrace.span("import PygameShader"):
+                try:
+                    from PygameShader import shader
+                except ImportError:
+                    ShaderLoader.available = False
+                    Settings.enable_shaders = False
+                    print("PygameShader module is required to enable shaders")
+                else:
+                    ShaderLoader.module = shader
+            ShaderLoader.loading = False
+
+        if ShaderLoader.module is not None or ShaderLoader.loading or not ShaderLoader.available:
+            return
+        ShaderLoader.loading = True
+        if sync:
+            thread()
+        else:
+            threading.Thread(target=thread, name="ShaderLoader", daemon=True).start()
 
 
 class AssetLoader:
     def __init__(self):
         Assets.set_dir("assets_glitchlands")
+        self.slot_meta = {}  # (stat key, metadata) per save file
+        self.slot_images = Cache(32)
+        self.button_faces = weakref.WeakKeyDictionary()  # (unpressed, pressed) per source surface
 
     def load(self):  # load main assets
         self.player = Assets.load_spritesheet_dir(
@@ -62,6 +96,9 @@ class AssetLoader:
         )
         self.ui.add("key_icons", Assets.load_spritesheet("ui/key_icons.png", (12, 12), (24, 24)))
         self.ui.add("credits", Assets.load_text("ui/credits.txt"))
+        for name in ("menu_buttons", "menu_buttons_small", "switch", "slider"):
+            for frame in self.ui.get(name):
+                self.get_button_faces(frame)
 
         terrain_image = Assets.load_image("objects/terrain.png")
         self.terrain = [  # terrain[type][style][num]
@@ -229,45 +266,76 @@ class AssetLoader:
         surface.fill(color)
         return surface
 
+    def get_button_faces(self, frame):  # shared by every ui.Button using the frame, never modify
+        if frame not in self.button_faces:
+            w, h = frame.get_size()
+            unpressed = Assets.sized_surface(w, h + 2)
+            unpressed.blit(frame, (0, 2))
+            unpressed.blit(frame, (0, 0))
+            pressed = Assets.sized_surface(w, h + 2)
+            pressed.blit(frame, (0, 2))
+            pressed.fill((32, 32, 32), special_flags=pygame.BLEND_RGB_ADD)
+            self.button_faces[frame] = (unpressed, pressed)
+        return self.button_faces[frame]
+
+    def read_slot_meta(self, fn):  # (difficulty, completed_time, elapsed_time, death_count)
+        if fn is None:
+            return None
+        try:
+            stat = os.stat(fn)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        if fn in self.slot_meta and self.slot_meta[fn][0] == key:
+            return self.slot_meta[fn][1]
+        with open(fn) as f:
+            save_data = json.load(f)
+        meta = (
+            save_data.get("difficulty", 0),
+            save_data.get("completed_time"),
+            save_data.get("elapsed_time", 0),
+            save_data.get("death_count", 0),
+        )
+        self.slot_meta[fn] = (key, meta)
+        return meta
+
+    def invalidate_slot(self, fn):
+        self.slot_meta.pop(fn, None)
+
     def save_slot_image(self, slot, fn):
-        if fn is not None and os.path.isfile(fn):
-            with open(fn) as f:
-                save_data = json.load(f)
-        else:
-            save_data = None
-        im = self.ui["slot_buttons"][
-            0 if save_data is None else save_data.get("difficulty", 0) + 1
-        ].copy()
+        meta = self.read_slot_meta(fn)
+        return self.slot_images.get(
+            (slot, meta, GlobalSave.best_time, GlobalSave.speedrun_mode),
+            lambda: self.render_save_slot_image(slot, meta),
+        )
+
+    def render_save_slot_image(self, slot, meta):
+        im = self.ui["slot_buttons"][0 if meta is None else meta[0] + 1].copy()
         cx = im.get_width() // 2
         if slot >= 0:
             text = self.font_small.render(f"Slot {slot+1}")
             im.blit(text, (cx - text.get_width() // 2, 10))
-        if save_data is not None:
+        if meta is not None:
+            difficulty, completed_time, elapsed_time, deaths = meta
             icon = None
-            if save_data.get("completed_time") is not None:
+            if completed_time is not None:
                 icon = (
-                    4
-                    if save_data["completed_time"] == GlobalSave.best_time
-                    and GlobalSave.speedrun_mode
-                    else 5
+                    4 if completed_time == GlobalSave.best_time and GlobalSave.speedrun_mode else 5
                 )
             if icon is not None:
                 im.blit(self.ui.get("menu_icons")[icon], (im.get_width() - 10 - 18, 10))
-            text = self.font_small.render(
-                ["Rookie", "Normal", "Master"][save_data.get("difficulty", 0)]
-            )
+            text = self.font_small.render(["Rookie", "Normal", "Master"][difficulty])
             im.blit(text, (cx - text.get_width() // 2, 42))
-            if GlobalSave.speedrun_mode and save_data.get("completed_time") is not None:
-                t = save_data["completed_time"]
+            if GlobalSave.speedrun_mode and completed_time is not None:
+                t = completed_time
             else:
-                t = save_data.get("elapsed_time", 0)
+                t = elapsed_time
             hours, rem = divmod(t, 3600)
             minutes, seconds = divmod(rem, 60)
             text = self.font_small.render(
                 "{:0>2}:{:0>2}:{:0>2}".format(int(hours), int(minutes), math.ceil(seconds))
             )
             im.blit(text, (cx - text.get_width() // 2, 64))
-            deaths = save_data.get("death_count", 0)
             text = self.font_small.render("1 death" if deaths == 1 else f"{deaths} deaths")
             im.blit(text, (cx - text.get_width() // 2, 86))
         elif slot < 0:
@@ -278,26 +346,56 @@ class AssetLoader:
             im.blit(text, (cx - text.get_width() // 2, 64))
         return im
 
-    def shield_static(self, sheet, copies=1, min_alpha=0, max_alpha=128):
+    def shield_static(self, sheet, copies=1, min_alpha=0, max_alpha=128, seed=None):
+        import numpy  # only needed here, keep it out of startup
+
+        rng = numpy.random.default_rng(seed)
         out = Spritesheet(
             sheet.width * copies, sheet.height * copies, hflip=sheet.hflip, vflip=sheet.vflip
         )
         for frame in sheet.sprites:
             for _ in range(copies):
                 surface = frame.copy()
-                for x in range(0, surface.get_width(), 2):
-                    for y in range(0, surface.get_height(), 2):
-                        if surface.get_at((x, y)) == (69, 69, 69, 255):
-                            pygame.draw.rect(
-                                surface,
-                                (255, 255, 255, random.randint(min_alpha, max_alpha)),
-                                (x, y, 2, 2),
-                            )
+                w, h = surface.get_size()
+                has_alpha = surface.get_flags() & pygame.SRCALPHA
+                rgb = pygame.surfarray.pixels3d(surface)
+                alpha = pygame.surfarray.pixels_alpha(surface) if has_alpha else None
+                # key colour on the top left pixel of each 2x2 block
+                key = (rgb[::2, ::2] == (69, 69, 69)).all(axis=2)
+                if has_alpha:
+                    key &= alpha[::2, ::2] == 255
+                mask = key.repeat(2, axis=0).repeat(2, axis=1)[:w, :h]
+                rgb[mask] = 255
+                if has_alpha:
+                    values = rng.integers(
+                        min_alpha, max_alpha, key.shape, numpy.uint8, endpoint=True
+                    )
+                    alpha[mask] = values.repeat(2, axis=0).repeat(2, axis=1)[:w, :h][mask]
+                del rgb, alpha  # unlock the surface
                 out.add(surface)
         return out
 
 
 class GameController(GameControllerBase):
+    frame_phases = [
+        "events",
+        "update",
+        "update.player",
+        "update.objects",
+        "update.particles",
+        "draw",
+        "draw.background",
+        "draw.objects",
+        "draw.player",
+        "draw.particles",
+        "draw.ui",
+        "overlays",
+        "overlays.shaders",
+        "overlays.hud",
+        "scale",
+        "display",
+    ]
+
     def __init__(self):
         super().__init__()
         self.save_slot = 0
@@ -305,9 +403,12 @@ class GameController(GameControllerBase):
             if os.path.exists(drive + ":\\"):
                 self.save_base = drive + ":\\glitchlands_save"
         GlobalSave.save_file = os.path.join(self.save_base, "glitchlands", "global.json")
-        GlobalSave.load()
+        with StartupTrace.span("GlobalSave.load"):
+            GlobalSave.load()
         Settings.save_file = os.path.join(self.save_base, "settings.json")
-        Settings.load_else_preset()
+        QualityGovernor.log_file = os.path.join(self.save_base, "quality_governor.log")
+        with StartupTrace.span("Settings.load"):
+            Settings.load_else_preset()
         self.shown_settings = []
         if not RASPBERRY_PI:
             self.shown_settings.append("windowed")
@@ -315,7 +416,9 @@ class GameController(GameControllerBase):
         if PYGAME_2:
             self.shown_settings.append("vsync")
         self.shown_settings.extend(["low_detail", "reduce_motion"])
-        if shader is None:
+        if RASPBERRY_PI:  # no room for it on desktop, where it's only in settings.json
+            self.shown_settings.append("adaptive_quality")
+        if not ShaderLoader.available:
             if Settings.enable_shaders:
                 Settings.enable_shaders = False
                 print("PygameShader module is required to enable shaders")
@@ -346,6 +449,7 @@ class GameController(GameControllerBase):
         self.visited_npcs = set()
         self.visited_one_ways = set()
         self.visited_final_world = False
+        self.map_canvas = MapCanvas(self)
         self.crystal_count, self.max_crystal_count, self.crystal_requirements = 0, 12, [5, 4, 3]
         self.death_count = 0
         self.elapsed_time = 0
@@ -365,11 +469,26 @@ class GameController(GameControllerBase):
         self.glitch_chance = -1
         self.difficulty = 1
         self.transition = None
+        self.hud = HudOverlay(self)
+        self.particles_this_step = 0
+        self.particle_counts = {  # for tuning the particle budget
+            "pushed": 0,
+            "dropped_low_detail": 0,
+            "dropped_step": 0,
+            "dropped_total": 0,
+            "evicted": 0,
+        }
         super().init()
-        MusicManager.load_loop_data(Assets.get("music/loop.json"))
-        self.assets.load()
-        self.background = Background(self, random.randint(0, 6))
-        self.set_menu(MENU_MAIN)
+        with StartupTrace.span("MusicManager.load_loop_data"):
+            MusicManager.load_loop_data(Assets.get("music/loop.json"))
+        with StartupTrace.span("AssetLoader.load"):
+            self.assets.load()
+        with StartupTrace.span("Background"):
+            self.background = Background(self, random.randint(0, 6))
+        with StartupTrace.span("set_menu(MENU_MAIN)"):
+            self.set_menu(MENU_MAIN)
+        if Settings.enable_shaders:
+            ShaderLoader.load(sync=False)
 
     def save_progress(self):
         now = time.perf_counter()
@@ -398,6 +517,7 @@ class GameController(GameControllerBase):
         os.makedirs(os.path.dirname(fn), exist_ok=True)
         with open(fn, "w") as f:
             json.dump(save_data, f, separators=(",", ":"))
+        self.assets.invalidate_slot(fn)
 
     def restore_progress(self):
         fn = self.get_save_file()
@@ -411,6 +531,7 @@ class GameController(GameControllerBase):
         self.player.abilities.load_json(save_data["abilities"])
         for attr in ("visited_levels", "visited_npcs", "visited_one_ways"):
             setattr(self, attr, set(tuple(pos) for pos in save_data.get(attr, getattr(self, attr))))
+        self.map_canvas = MapCanvas(self)
         for attr in (
             "visited_final_world",
             "crystal_count",
@@ -560,7 +681,7 @@ class GameController(GameControllerBase):
         MusicManager.load(Assets.get(f"music/{name}.ogg"))
 
     def play_sound(self, name, volume=1):
-        if Settings.volume_sfx == 0:
+        if Settings.volume_sfx == 0 or self.headless:
             return
         sound = self.assets.sounds.get(name)
         sound.set_volume(Settings.volume_sfx * volume)
@@ -620,6 +741,7 @@ class GameController(GameControllerBase):
 
     def set_menu(self, menu, submenu=0, idx=(0, 0)):
         self.ui_objects = []
+        self.ui_scroll = (0, 0)
         mx = [0, 0]
         scrollable = False
         buttons = self.assets.ui.get("menu_buttons")
@@ -784,216 +906,31 @@ class GameController(GameControllerBase):
             self.selection.disable_mouse()
             self.load_music()
         elif menu == MENU_MAP:
-            level_size = (100, 60)
-            color_key = [
-                (170, 186, 206),  # light
-                (213, 177, 149),
-                (194, 194, 194),
-                (147, 197, 150),
-                (209, 169, 191),
-                (181, 169, 201),
-                (213, 204, 158),
-                (85, 69, 49),  # dark
-                (42, 78, 106),
-                (61, 61, 61),
-                (108, 58, 105),
-                (46, 86, 64),
-                (74, 86, 54),
-                (42, 51, 97),
-                (255, 0, 255),  # missing
-                (136, 0, 136),
-            ]
-            visited = {self.level.level_pos, *self.visited_levels}
-            level_icons = []  # (num, x, y)
-            teleporter_lines = []  # (x1, y1, x2, y2)
-            visited_levels, total_levels = 0, 0
-            for world, world_data in enumerate(self.assets.map.get("data")):
-                for pos_string, tile_data in world_data.get("levels", {}).items():
-                    total_levels += 1
-                    pos = (world,) + tuple(int(n) for n in pos_string.split(","))
-                    if pos not in visited and pos != self.level.level_pos:
-                        continue
-                    visited_levels += 1
-                    icon_key = {
-                        "upgrade": 2,
-                        "lever": 3,
-                        "crystal": 6 if pos in [npc[1:] for npc in self.visited_npcs] else 5,
-                        "teleporter": 7,
-                        "virus": 8,
-                    }
-                    color = tile_data.get("color", 2)
-                    if pos == self.level.level_pos:
-                        color = self.background.num
-                    elif color == -1:
-                        color = random.randint(0, 6)
-                    elif color == -2:
-                        color = random.randint(7, 13)
-                    elif color == -3:
-                        color = random.randint(0, 13)
-                    fill = color_key[color]
-                    if color in (7, 8, 9, 10, 11, 12, 13, 15):
-                        stroke = tuple(int(n * 1.3) for n in fill)
-                    else:
-                        stroke = tuple(int(n * 0.8) for n in fill)
-                    surface = Assets.sized_surface(level_size)
-                    surface.fill(fill)
-                    borders = tile_data.get("borders", [])
-                    pygame.draw.rect(surface, stroke, (0, 0, level_size[0], level_size[1]), 2)
-                    border_w, border_h = (
-                        math.ceil((level_size[0] - 4) / 3),
-                        math.ceil((level_size[1] - 4) / 3),
-                    )
-                    level_left = (
-                        tuple(tile_data["left"])
-                        if "left" in tile_data
-                        else (pos[0], pos[1] - 1, pos[2])
-                    )
-                    level_top = (
-                        tuple(tile_data["top"])
-                        if "top" in tile_data
-                        else (pos[0], pos[1], pos[2] - 1)
-                    )
-                    level_right = (
-                        tuple(tile_data["right"])
-                        if "right" in tile_data
-                        else (pos[0], pos[1] + 1, pos[2])
-                    )
-                    level_bottom = (
-                        tuple(tile_data["bottom"])
-                        if "bottom" in tile_data
-                        else (pos[0], pos[1], pos[2] + 1)
-                    )
-                    if level_left in visited:
-                        if 0 in borders:
-                            pygame.draw.rect(
-                                surface, fill, (0, level_size[1] - 2 - border_h, 3, border_h)
-                            )
-                        if 1 in borders:
-                            pygame.draw.rect(
-                                surface, fill, (0, level_size[1] // 2 - border_h // 2, 3, border_h)
-                            )
-                        if 2 in borders:
-                            pygame.draw.rect(surface, fill, (0, 2, 3, border_h))
-                    if level_top in visited:
-                        if 3 in borders:
-                            pygame.draw.rect(surface, fill, (2, 0, border_w, 3))
-                        if 4 in borders:
-                            pygame.draw.rect(
-                                surface, fill, (level_size[0] // 2 - border_w // 2, 0, border_w, 3)
-                            )
-                        if 5 in borders:
-                            pygame.draw.rect(
-                                surface, fill, (level_size[0] - 2 - border_w, 0, border_w, 3)
-                            )
-                    if level_right in visited:
-                        if 6 in borders:
-                            pygame.draw.rect(surface, fill, (level_size[0] - 3, 2, 3, border_h))
-                        if 7 in borders:
-                            pygame.draw.rect(
-                                surface,
-                                fill,
-                                (
-                                    level_size[0] - 3,
-                                    level_size[1] // 2 - border_h // 2,
-                                    3,
-                                    border_h,
-                                ),
-                            )
-                        if 8 in borders:
-                            pygame.draw.rect(
-                                surface,
-                                fill,
-                                (level_size[0] - 3, level_size[1] - 2 - border_h, 3, border_h),
-                            )
-                    if level_bottom in visited:
-                        if 9 in borders:
-                            pygame.draw.rect(
-                                surface,
-                                fill,
-                                (level_size[0] - 2 - border_w, level_size[1] - 3, border_w, 3),
-                            )
-                        if 10 in borders:
-                            pygame.draw.rect(
-                                surface,
-                                fill,
-                                (
-                                    level_size[0] // 2 - border_w // 2,
-                                    level_size[1] - 3,
-                                    border_w,
-                                    3,
-                                ),
-                            )
-                        if 11 in borders:
-                            pygame.draw.rect(surface, fill, (2, level_size[1] - 3, border_w, 3))
-                    cx = (pos[1] + world_data.get("xofs", 0)) * level_size[0] + self.game_width // 2
-                    cy = (pos[2] + world_data.get("yofs", 0)) * level_size[
-                        1
-                    ] + self.game_height // 2
-                    ui.create_graphic(self, surface, cx=cx, cy=cy)
-                    if tile_data.get("icon_name") and (
-                        tile_data.get("icon_hide_level") is None
-                        or tuple(tile_data["icon_hide_level"]) not in visited
-                    ):  # level icon
-                        icon_pos = tile_data.get("icon_pos", [0, 0])
-                        icon_x, icon_y = cx + icon_pos[0] * (level_size[0] // 3), cy + icon_pos[
-                            1
-                        ] * (level_size[1] // 4)
-                        level_icons.append((icon_key[tile_data["icon_name"]], icon_x, icon_y))
-                        if tile_data.get("warp_target"):
-                            target_pos = tuple(tile_data["warp_target"])
-                            if target_pos in visited or target_pos == self.level.level_pos:
-                                target_world_data = self.assets.map["data"][target_pos[0]]
-                                target_cx = (
-                                    target_pos[1] + target_world_data.get("xofs", 0)
-                                ) * level_size[0] + self.game_width // 2
-                                target_cy = (
-                                    target_pos[2] + target_world_data.get("yofs", 0)
-                                ) * level_size[1] + self.game_height // 2
-                                target_tile_data = target_world_data.get("levels", {}).get(
-                                    ",".join([str(n) for n in target_pos[1:]]), {}
-                                )
-                                target_icon_pos = target_tile_data.get("icon_pos", [0, 0])
-                                teleporter_lines.append(
-                                    (
-                                        icon_x,
-                                        icon_y,
-                                        target_cx + target_icon_pos[0] * (level_size[0] // 3),
-                                        target_cy + target_icon_pos[1] * (level_size[1] // 4),
-                                    )
-                                )
-                    if pos == self.level.level_pos:  # player icon
-                        level_icons.insert(
-                            0,
-                            (
-                                0 if self.player.facing_right else 1,
-                                cx
-                                + (self.player.x + self.player.rectw // 2 - self.game_width // 2)
-                                / self.game_width
-                                * (level_size[0] - 30),
-                                cy
-                                + (self.player.y + self.player.recth // 2 - self.game_height // 2)
-                                / self.game_height
-                                * (level_size[1] - 30),
-                            ),
-                        )
-                        idx = (self.game_width // 2 - cx, self.game_height // 2 - cy)
-            for x1, y1, x2, y2 in teleporter_lines:
-                surface = Assets.sized_surface(abs(x2 - x1), abs(y2 - y1))
-                pygame.draw.line(
-                    surface,
-                    WHITE,
-                    (x1 - min(x1, x2), y1 - min(y1, y2)),
-                    (x2 - min(x1, x2), y2 - min(y1, y2)),
-                    3,
+            self.map_canvas.update()
+            for surface, (x, y), hide_ok in self.map_canvas.get_layers():
+                graphic = ui.create_graphic(self, surface)
+                graphic.rect.topleft = (x + self.game_width // 2, y + self.game_height // 2)
+                graphic.hide_ok = hide_ok
+            if self.level.level_pos in self.map_canvas.tiles:  # player icon
+                level_w, level_h = self.map_canvas.level_size
+                cx, cy = self.map_canvas.get_center(self.level.level_pos)
+                ui.create_graphic(
+                    self,
+                    self.assets.map["icons"][0 if self.player.facing_right else 1],
+                    cx=cx
+                    + self.game_width // 2
+                    + (self.player.x + self.player.rectw // 2 - self.game_width // 2)
+                    / self.game_width
+                    * (level_w - 30),
+                    cy=cy
+                    + self.game_height // 2
+                    + (self.player.y + self.player.recth // 2 - self.game_height // 2)
+                    / self.game_height
+                    * (level_h - 30),
                 )
-                if Settings.enable_transparency:
-                    surface.set_alpha(64)
-                line = ui.create_graphic(self, surface, cx=(x1 + x2) // 2, cy=(y1 + y2) // 2)
-                line.hide_ok = True
-            for num, x, y in level_icons[::-1]:
-                icon = ui.create_graphic(self, self.assets.map["icons"][num], cx=x, cy=y)
-                icon.hide_ok = True
-            self.ui_objects[-1].hide_ok = False
+                idx = (-cx, -cy)
+            visited_levels = self.map_canvas.revealed_count
+            total_levels = self.map_canvas.total_count
             y = 24
             graphic = ui.create_graphic(
                 self,
@@ -1042,6 +979,10 @@ class GameController(GameControllerBase):
             mx = [2, 1]
         self.selection.set(idx, mx, menu, submenu)
         self.selection.initial = idx
+        self.ui_layers = [  # (objects, scrolled), fixed objects are drawn over the scrolled ones
+            ([obj for obj in self.ui_objects if scrollable and not obj.fixed], True),
+            ([obj for obj in self.ui_objects if not scrollable or obj.fixed], False),
+        ]
         if scrollable:
             self.selection.scrollable = True
             self.update_scrolling_menu()
@@ -1145,6 +1086,8 @@ class GameController(GameControllerBase):
                 cls.set(attr, enabled)
                 if attr in ("windowed", "vsync"):
                     self.init_display()
+                elif attr == "enable_shaders" and enabled:
+                    ShaderLoader.load(sync=False)
                 cls.save()
                 if button is not None:
                     button.update_frames(self.assets.ui.get("switch")[1 if enabled else 2])
@@ -1229,12 +1172,10 @@ class GameController(GameControllerBase):
         if self.selection.menu == MENU_MAP:
             self.selection.x = min(max(self.selection.x, 100 * -3), 100 * 15)
             self.selection.y = min(max(self.selection.y, 60 * -6), 60 * 3)
-        for obj in self.ui_objects:
-            if not obj.fixed:
-                obj.xofs = self.selection.x
-                obj.yofs = self.selection.y
+        self.ui_scroll = (self.selection.x, self.selection.y)
 
     def update(self):
+        self.particles_this_step = 0
         if self.should_toggle_in_game and (self.transition is None or self.transition.halfway):
             if not self.in_game:
                 if self.transition is not None and self.transition.halfway:
@@ -1249,8 +1190,11 @@ class GameController(GameControllerBase):
                 self.set_menu(self.selection.menu)
 
         self.prev_xscroll = self.xscroll
-        Input.update(pygame.key.get_pressed())
-        perf = time.perf_counter()
+        Input.update()
+        if InputRecording.mode is None:
+            perf = time.perf_counter()
+        else:  # simulation time, so menu navigation replays the same
+            perf = self.ticks / self.tick_rate
 
         if Input.any_button or Input.any_direction:
             if self.selection.idx is None and not self.selection.scrollable:
@@ -1263,13 +1207,15 @@ class GameController(GameControllerBase):
             self.selection.disable_mouse()
 
         if self.in_game and self.selection.menu == MENU_IN_GAME:
-            self.update_objects(self.glitch_zones)
-            self.update_objects(self.player_attacks)
+            with FrameTimer.phase("update.objects"):
+                self.update_objects(self.glitch_zones)
+                self.update_objects(self.player_attacks)
             if self.npc_dialogue.hidden:
-                self.player.update_physics()
-                self.player.update_animations()
+                with FrameTimer.phase("update.player"):
+                    self.player.update_physics()
+                    self.player.update_animations()
             if (
-                not Settings.low_detail
+                QualityGovernor.allows("glitches")
                 and self.glitch_chance >= 0
                 and random.randint(0, self.glitch_chance // 40) == 0
             ):
@@ -1287,10 +1233,12 @@ class GameController(GameControllerBase):
                 self.ambience_timer -= 1
             if not Settings.reduce_motion:
                 self.background.update()
-            self.update_objects(self.objects_collide)
-            self.update_objects(self.background_deco)
-            self.update_objects(self.foreground_deco)
-            self.update_objects(self.particles)
+            with FrameTimer.phase("update.objects"):
+                self.update_objects(self.objects_collide)
+                self.update_objects(self.background_deco)
+                self.update_objects(self.foreground_deco)
+            with FrameTimer.phase("update.particles"):
+                self.update_objects(self.particles)
             if self.xscroll != self.xscroll_target:
                 if self.frame == 0:
                     self.xscroll = self.xscroll_target
@@ -1317,7 +1265,8 @@ class GameController(GameControllerBase):
                 ):
                     self.enable_pause(MENU_MAP)
             if self.npc_dialogue.hidden:
-                self.player.update_attacks()
+                with FrameTimer.phase("update.player"):
+                    self.player.update_attacks()
             self.npc_dialogue.update()
             self.selection.button_pressed = any(
                 [
@@ -1441,120 +1390,142 @@ class GameController(GameControllerBase):
         # welcome to my very epic, complicated, and definitely optimized draw code
         # (it's actually not that bad now that fullscreen_refresh is gone)
         self.rects = []
-        self.background.draw()
+        with FrameTimer.phase("draw.background"):
+            self.background.draw()
         if self.in_game and self.selection.menu == MENU_IN_GAME:  # draw level
-            for obj in self.background_deco + self.glitch_zones + self.get_block_objects():
-                obj.draw()
+            with FrameTimer.phase("draw.objects"):
+                for obj in self.background_deco + self.glitch_zones + self.get_block_objects():
+                    obj.draw()
+                    if Settings.show_hitboxes:
+                        obj.draw_hitbox()
+            with FrameTimer.phase("draw.player"):
+                self.rects.append(self.player.draw())
                 if Settings.show_hitboxes:
-                    obj.draw_hitbox()
-            self.rects.append(self.player.draw())
-            if Settings.show_hitboxes:
-                self.rects.append(self.player.draw_hitbox())
-            for part in self.particles:
-                if not Settings.low_detail or part.show_low_detail:
-                    self.rects.append(part.draw())
-            for atk in self.player_attacks:
-                self.rects.append(atk.draw())
-                if Settings.show_hitboxes:
-                    self.rects.append(atk.draw_hitbox())
-            for deco in self.foreground_deco:
-                self.rects.append(deco.draw())
-                if Settings.show_hitboxes:
-                    self.rects.append(deco.draw_hitbox())
-        for obj in self.ui_objects:  # draw ui
-            if obj.hide_ok and Input.primary:
-                continue
-            self.rects.append(obj.draw())
+                    self.rects.append(self.player.draw_hitbox())
+            with FrameTimer.phase("draw.particles"):
+                low_detail = Settings.low_detail
+                for part in self.particles:
+                    if not low_detail or part.show_low_detail:
+                        self.rects.append(part.draw())
+            with FrameTimer.phase("draw.player"):
+                for atk in self.player_attacks:
+                    self.rects.append(atk.draw())
+                    if Settings.show_hitboxes:
+                        self.rects.append(atk.draw_hitbox())
+            with FrameTimer.phase("draw.objects"):
+                for deco in self.foreground_deco:
+                    self.rects.append(deco.draw())
+                    if Settings.show_hitboxes:
+                        self.rects.append(deco.draw_hitbox())
+        with FrameTimer.phase("draw.ui"):
+            for objs, scrolled in self.ui_layers:  # draw ui
+                xofs, yofs = self.ui_scroll if scrolled else (0, 0)
+                view = pygame.Rect(-xofs - 1, -yofs - 1, self.game_width + 2, self.game_height + 2)
+                for obj in objs:
+                    if obj.hide_ok and Input.primary:
+                        continue
+                    if scrolled and not view.colliderect(obj.rect):  # outside of the viewport
+                        continue
+                    self.rects.append(obj.draw(xofs, yofs))
 
     def draw_overlays(self):
-        # shaders
-        if Settings.enable_shaders:
+        with FrameTimer.phase("overlays.shaders"):
+            shader = ShaderLoader.module
+            if QualityGovernor.allows("shaders") and shader is not None:
+                if (
+                    not self.in_game
+                    or self.glitch_chance <= 0
+                    or random.randint(0, self.glitch_chance) // 2 > 0
+                ):
+                    if self.in_game and self.selection.menu == MENU_IN_GAME:
+                        cx, cy = self.game_width // 2, self.player.y + self.player.recth // 2
+                        amount = (
+                            (4000 - self.glitch_chance) / 250000
+                            if self.glitch_chance > 0
+                            else 0.008
+                        )
+                        if self.level.level_pos[0] == 0:
+                            cy = self.game_height // 2
+                    else:
+                        cx, cy = self.game_width // 2, self.game_height // 2
+                        amount = 0.005
+                    self.apply_to_screen(
+                        shader.chromatic,
+                        min(max(cx, 0), self.game_width),
+                        min(max(cy, 0), self.game_height),
+                        0.9999,
+                        fx=amount,
+                    )
+                elif random.randint(0, 1) == 0:
+                    self.apply_to_screen(shader.tv_scan, random.randint(5, 20))
+        with FrameTimer.phase("overlays.hud"):
+            # dialogue
+            if self.in_game and self.selection.menu == MENU_IN_GAME:
+                if self.npc_dialogue.shown and self.npc_dialogue.current.content is not None:
+                    container = self.assets.ui.get("dialogue_container")
+                    self.screen.blit(
+                        container,
+                        (
+                            self.game_width // 2 - container.get_width() // 2,
+                            self.game_height - container.get_height() - 8,
+                        ),
+                    )
+                    content = self.assets.font.render(self.npc_dialogue.current.content)
+                    self.screen.blit(
+                        content,
+                        (
+                            self.game_width // 2 - content.get_width() // 2,
+                            self.game_height
+                            - 80
+                            - content.get_height() // 2
+                            - max(4 - self.npc_dialogue.change_frame, 0),
+                        ),
+                    )
+                    owner = self.assets.font.render(self.npc_dialogue.current.owner)
+                    self.screen.blit(owner, (40, self.game_height - 160))
+            # screen transition
+            if self.transition is not None:
+                self.rects.append(self.transition.draw())
+            # top left corner
+            self.rects.append(self.hud.draw())
             if (
-                not self.in_game
-                or self.glitch_chance <= 0
-                or random.randint(0, self.glitch_chance) // 2 > 0
+                RASPBERRY_PI
+                and not (self.in_game and self.selection.menu == MENU_IN_GAME)
+                and not self.selection.menu == MENU_MAP
             ):
-                if self.in_game and self.selection.menu == MENU_IN_GAME:
-                    cx, cy = self.game_width // 2, self.player.y + self.player.recth // 2
-                    amount = (
-                        (4000 - self.glitch_chance) / 250000 if self.glitch_chance > 0 else 0.008
-                    )
-                    if self.level.level_pos[0] == 0:
-                        cy = self.game_height // 2
-                else:
-                    cx, cy = self.game_width // 2, self.game_height // 2
-                    amount = 0.005
-                self.screen = shader.chromatic(
-                    self.screen,
-                    min(max(cx, 0), self.game_width),
-                    min(max(cy, 0), self.game_height),
-                    0.9999,
-                    fx=amount,
-                )
-            elif random.randint(0, 1) == 0:
-                shader.tv_scan(self.screen, random.randint(5, 20))
-        # dialogue
-        if self.in_game and self.selection.menu == MENU_IN_GAME:
-            if self.npc_dialogue.shown and self.npc_dialogue.current.content is not None:
-                container = self.assets.ui.get("dialogue_container")
-                self.screen.blit(
-                    container,
-                    (
-                        self.game_width // 2 - container.get_width() // 2,
-                        self.game_height - container.get_height() - 8,
-                    ),
-                )
-                content = self.assets.font.render(self.npc_dialogue.current.content)
-                self.screen.blit(
-                    content,
-                    (
-                        self.game_width // 2 - content.get_width() // 2,
-                        self.game_height
-                        - 80
-                        - content.get_height() // 2
-                        - max(4 - self.npc_dialogue.change_frame, 0),
-                    ),
+                indicator = Assets.status_indicator()
+                self.rects.append(
+                    self.screen.blit(indicator, (0, self.game_height - indicator.get_height()))
                 )
-                owner = self.assets.font.render(self.npc_dialogue.current.owner)
-                self.screen.blit(owner, (40, self.game_height - 160))
-        # screen transition
-        if self.transition is not None:
-            self.rects.append(self.transition.draw())
-        # top left corner
-        y = 0
-        overlays = []
-        if Settings.show_fps:
-            text = Assets.debug_font.render(str(round(self.clock.get_fps(), 2)), False, WHITE)
-            overlays.append((text, (3, y + 2)))
-            y += 16
-        if GlobalSave.speedrun_mode and self.in_game:
-            text = Assets.debug_font.render(
-                self.format_elapsed(self.get_elapsed_time()), False, WHITE
-            )
-            overlays.append((text, (3, y + 2)))
-            y += 16
-            for split in self.splits[-5:]:
-                text = Assets.debug_font.render(split[0], False, WHITE)
-                overlays.append((text, (3, y + 2)))
-                text = Assets.debug_font.render(split[2], False, WHITE)
-                overlays.append((text, (180 - text.get_width() - 3, y + 2)))
-                y += 16
-        if (
-            RASPBERRY_PI
-            and not (self.in_game and self.selection.menu == MENU_IN_GAME)
-            and not self.selection.menu == MENU_MAP
-        ):
-            indicator = Assets.status_indicator()
-            overlays.append((indicator, (0, self.game_height - indicator.get_height())))
-        if y > 16 and self.in_game:
-            shade = Assets.sized_surface(180, y)
-            shade.fill((0, 0, 0, 128))
-            self.rects.append(self.screen.blit(shade, (0, 0)))
-        for args in overlays:
-            self.rects.append(self.screen.blit(*args))
 
     def push_particle(self, *parts):
-        self.particles.extend(parts)
+        counts = self.particle_counts
+        cosmetic = not Settings.low_detail  # otherwise they wouldn't be drawn anyway
+        max_particles = QualityGovernor.particle_budget(Settings.max_particles)
+        max_per_step = QualityGovernor.particle_budget(Settings.max_particles_per_step)
+        for part in parts:
+            counts["pushed"] += 1
+            if part.show_low_detail:  # kept, making room by removing the oldest cosmetic particle
+                if len(self.particles) >= max_particles:
+                    i = next(
+                        (i for i, p in enumerate(self.particles) if not p.show_low_detail), None
+                    )
+                    if i is None:
+                        counts["dropped_total"] += 1
+                        continue
+                    self.particles.pop(i)
+                    counts["evicted"] += 1
+            elif not cosmetic:
+                counts["dropped_low_detail"] += 1
+                continue
+            elif self.particles_this_step >= max_per_step:
+                counts["dropped_step"] += 1
+                continue
+            elif len(self.particles) >= max_particles:
+                counts["dropped_total"] += 1
+                continue
+            self.particles.append(part)
+            self.particles_this_step += 1
 
     def push_player_attack(self, *atks):
         self.player_attacks.extend(atks)
@@ -1639,6 +1610,7 @@ class GameController(GameControllerBase):
         self.glitch_zones = []
         self.player_attacks = []
         self.ui_objects = []
+        self.ui_layers = []
 
     def delete_objects_from_level(self, pos):
         filt = lambda arr: list(filter(lambda obj: obj.level.level_pos != pos, arr))
@@ -1702,6 +1674,7 @@ class GameController(GameControllerBase):
     def append_visited(self, next_pos=None, only_next=False):
         if not only_next:
             self.visited_levels.add(self.level.level_pos)
+            self.map_canvas.reveal(self.level.level_pos)
         if next_pos is not None:
             if next_pos[0] <= 0:
                 self.assets.load_virus()
@@ -1922,10 +1895,95 @@ if __name__ == "__main__":
     parser.add_argument(
         "-s", "--slot", type=int, help="Automatically start with the specified slot index"
     )
+    parser.add_argument(
+        "--trace-startup",
+        nargs="?",
+        const=os.path.join("save", "startup_trace.json"),
+        metavar="FILE",
+        help="Print a startup timing report and write it as JSON to the specified file",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Only run the simulation, without a window, rendering or audio",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        metavar="N",
+        help="Exit after N simulation steps (headless mode only)",
+    )
+    parser.add_argument(
+        "--record", metavar="FILE", help="Record the input of this run to the specified file"
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Replay a recorded run, starting in the slot it was recorded with",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="Random seed for a recorded run (random if not specified)"
+    )
+    parser.add_argument(
+        "--frame-timing",
+        action="store_true",
+        help="Show a graph of how long each phase of a frame takes (toggle with F3)",
+    )
+    parser.add_argument(
+        "--frame-csv",
+        nargs="?",
+        const=os.path.join("save", "frame_timing.csv"),
+        metavar="FILE",
+        help="Write the duration of each phase of every frame to a CSV file (toggle with F4)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        default=GameController.profile_window,
+        metavar="SECONDS",
+        help="Length of the sampling profiler's window (started with F5 or --profile-at)",
+    )
+    parser.add_argument(
+        "--profile-at",
+        type=int,
+        metavar="STEP",
+        help="Start the sampling profiler at the specified simulation step (0 for immediately)",
+    )
+    parser.add_argument(
+        "--adaptive-quality",
+        action="store_true",
+        help="Turn quality features down when frames are too slow, for this run only",
+    )
+    parser.add_argument(
+        "--threaded-render",
+        action="store_true",
+        help="Render frames on a second thread while the next is simulated, for this run only",
+    )
     args, unknown = parser.parse_known_args()
-    gc = GameController()
-    gc.init()
+    if args.replay is not None:
+        InputRecording.start_replay(args.replay)
+        if args.slot is None:
+            args.slot = InputRecording.slot
+    elif args.record is not None:
+        InputRecording.start_recording(args.record, args.seed, args.slot)
+    if args.trace_startup is not None:
+        StartupTrace.enable(args.trace_startup)
+    with StartupTrace.span("GameController.__init__"):
+        gc = GameController()
+    with StartupTrace.span("GameController.init"):
+        gc.init()
+    if args.adaptive_quality:
+        Settings.override("adaptive_quality", True)
+    if args.threaded_render:
+        Settings.override("threaded_render", True)
+    if args.frame_timing:
+        FrameTimer.toggle_graph(True)
+    if args.frame_csv is not None:
+        FrameTimer.start_csv(args.frame_csv)
     if args.slot is not None:
         gc.save_slot = args.slot
         gc.init_level()
+    gc.headless_steps = args.steps
+    gc.profile_window = args.profile
+    gc.profile_at = args.profile_at
     gc.mainloop()
@@ -1,4 +1,8 @@
-import sys, math, os, time, json, threading, platform
+import sys, math, os, time, json, csv, random, threading, platform
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, deque
+
+_import_time = time.perf_counter()
 
 import pygame
 from pygame.locals import*
@@ -44,6 +48,28 @@ class Input(object):
     left, right, up, down, stick_button, primary, secondary, x, y, l, r, l2, r2, escape, start, select, reset, any_button, any_direction = [False for _ in range(len(keys))]
     button_bcm_map = {"primary": 17, "secondary": 22, "x": 4, "y": 27, "l": 19, "r": 24, "l2": 26, "r2": 23, "start": 25, "select": 21, "stick_button": 20}
     button_instances = {}
+    key_map = { # keyboard keys per input
+        K_LEFT: "left", K_a: "left", K_KP4: "left",
+        K_RIGHT: "right", K_d: "right", K_KP6: "right",
+        K_UP: "up", K_w: "up", K_KP8: "up",
+        K_DOWN: "down", K_s: "down", K_KP2: "down",
+        K_BACKSLASH: "stick_button",
+        K_k: "primary", K_SPACE: "primary",
+        K_l: "secondary", K_e: "secondary", K_SLASH: "secondary", K_KP_PLUS: "secondary",
+        K_j: "x", K_i: "y", K_u: "l", K_o: "r",
+        K_RETURN: "start", K_KP_ENTER: "start",
+        K_TAB: "select", K_ESCAPE: "escape", K_r: "reset"
+    }
+    bits = {name: 1 << i for i, name in enumerate(keys)} # bit of each input in the masks below
+    button_bits = sum(map(bits.get, ("primary", "secondary", "start", "x", "y", "select", "escape", "reset"))) # any_button
+    direction_bits = sum(map(bits.get, ("left", "right", "up", "down"))) # any_direction
+    mask = 0 # inputs held as of the last update
+    held_keys = set() # keyboard keys down, kept by KEYDOWN/KEYUP events
+    held_buttons = set() # gpio buttons down, kept by their edge callbacks
+    held_mask = 0
+    held_changed = True # held keys or buttons changed since the last update
+    joystick_rate = 100 # joystick samples per second
+    stick_snapshot = ((0, 0), 0, 0, 0) # (position, amount, angle, direction bits) of the latest joystick sample
     stick_position = (0, 0)
     stick_amount = 0
     stick_angle = 0
@@ -55,11 +81,17 @@ class Input(object):
     cpu_temp = None
     memory_usage = None
     last_hardware_update = 0
+    last_hardware_request = 0
+    hardware_snapshot = (None, None, None, None) # (battery_percent, battery_charging, cpu_temp, memory_usage)
     _ts = None # ft5406 instance (for touchscreen)
     _mcp = None # gpiozero.mcp3008 instance (for joystick)
     _bus = None # smbus.smbus instance (for i2c)
     _embpi = None # pyembedded.raspberry_pi_tools.raspberrypi.PI instance (for usage stats)
     _psutil = None # psutil module (substitute for other modules on windows)
+    _sampler = None # threading.Thread instance (for reading hardware devices off the main thread)
+    _sampler_stop = None # threading.Event instance (set to stop the sampler)
+    _joystick_sampler = None # threading.Thread instance (for reading the joystick at its own rate)
+    _joystick_stop = None # threading.Event instance (set to stop the joystick sampler)
 
     if SWAP_A_B_BUTTONS:
         button_bcm_map["primary"], button_bcm_map["secondary"] = button_bcm_map["secondary"], button_bcm_map["primary"]
@@ -87,10 +119,15 @@ class Input(object):
                     print("Failed to load GPIO")
                 else:
                     for k, v in Input.button_bcm_map.items():
-                        Input.button_instances[k] = Button(v)
+                        button = Button(v)
+                        button.when_pressed = lambda _, name=k: Input.set_button(name, True)
+                        button.when_released = lambda _, name=k: Input.set_button(name, False)
+                        Input.button_instances[k] = button
+                        Input.set_button(k, button.is_pressed)
                     Input._mcp = MCP3008
                     Input.joystick_x = MCP3008(0)
                     Input.joystick_y = MCP3008(1)
+                    Input.start_joystick_sampler()
                 try:
                     Input._ts = ft5406.Touchscreen(device="raspberrypi-ts")
                 except RuntimeError:
@@ -118,10 +155,14 @@ class Input(object):
                     pass
                 else:
                     Input._psutil = psutil
+        if hardware_devices:
+            Input.start_hardware_sampler()
 
     @staticmethod
     def stop():
+        Input.stop_joystick_sampler()
         Input.stop_gpio()
+        Input.stop_hardware_sampler()
         if Input._ts is not None:
             Input._ts.stop()
     
@@ -148,6 +189,66 @@ class Input(object):
             if Settings.joystick_calibration[2] == Settings.joystick_calibration[1]: jy = 0
             else: jy *= Input.joystick_radius/(Settings.joystick_calibration[2]-Settings.joystick_calibration[1])
         return jx, jy
+
+    @staticmethod
+    def sample_joystick():
+        jx, jy = Input.get_joystick()
+        amount = math.sqrt(jx*jx+jy*jy)
+        angle = math.degrees(math.atan2(jy, jx))
+        if angle < 0: angle += 360
+        directions = 0
+        if amount > Input.joystick_deadzone:
+            overlap = 60
+            if angle < overlap or angle > 360-overlap: directions |= Input.bits["right"]
+            if 90-overlap < angle < 90+overlap: directions |= Input.bits["up"]
+            if 180-overlap < angle < 180+overlap: directions |= Input.bits["left"]
+            if 270-overlap < angle < 270+overlap: directions |= Input.bits["down"]
+        return (jx, jy), amount, angle, directions
+
+    @staticmethod
+    def start_joystick_sampler():
+        if Input._joystick_sampler is not None or Input._mcp is None: return
+        def thread():
+            while not Input._joystick_stop.is_set():
+                Input.stick_snapshot = Input.sample_joystick() # replaced whole, so it's never read half written
+                Input._joystick_stop.wait(1/Input.joystick_rate)
+        Input._joystick_stop = threading.Event()
+        Input._joystick_sampler = threading.Thread(target=thread, daemon=True)
+        Input._joystick_sampler.start()
+
+    @staticmethod
+    def stop_joystick_sampler():
+        if Input._joystick_sampler is None: return
+        Input._joystick_stop.set()
+        Input._joystick_sampler = None
+
+    @staticmethod
+    def set_button(name, pressed): # gpio edge callback, called from gpiozero's thread
+        if pressed: Input.held_buttons.add(name)
+        else: Input.held_buttons.discard(name)
+        Input.held_changed = True
+
+    @staticmethod
+    def handle_event(event): # keeps the held keys, for every event taken off the queue
+        if event.type == pygame.KEYDOWN:
+            if event.key in Input.key_map:
+                Input.held_keys.add(event.key)
+                Input.held_changed = True
+        elif event.type == pygame.KEYUP:
+            if event.key in Input.key_map:
+                Input.held_keys.discard(event.key)
+                Input.held_changed = True
+        elif PYGAME_2 and event.type == pygame.WINDOWFOCUSLOST: # key ups may never arrive
+            Input.held_keys.clear()
+            Input.held_changed = True
+        elif PYGAME_2 and event.type == pygame.WINDOWFOCUSGAINED: # keys may have gone down while unfocused
+            Input.sync_keys()
+
+    @staticmethod
+    def sync_keys(): # rebuilds the held keys from a poll, for keys already down when no events were seen
+        keys = pygame.key.get_pressed()
+        Input.held_keys = {key for key in Input.key_map if keys[key]}
+        Input.held_changed = True
     
     @staticmethod
     def set_touch_handlers(press=None, release=None, move=None):
@@ -160,56 +261,49 @@ class Input(object):
     @staticmethod
     def show_mouse(shown):
         Input.mouse_visible = shown
-        if hasattr(pygame, "SYSTEM_CURSOR_ARROW"):
-            if shown: pygame.mouse.set_cursor(SYSTEM_CURSOR_ARROW)
-            else: pygame.mouse.set_cursor((8,8),(0,0),(0,0,0,0,0,0,0,0),(0,0,0,0,0,0,0,0))
-        else:
-            pygame.mouse.set_visible(shown)
-
-    @staticmethod
-    def update(keys):
-        Input.left = keys[K_LEFT] or keys[K_a] or keys[K_KP4]
-        Input.right = keys[K_RIGHT] or keys[K_d] or keys[K_KP6]
-        Input.up = keys[K_UP] or keys[K_w] or keys[K_KP8]
-        Input.down = keys[K_DOWN] or keys[K_s] or keys[K_KP2]
-        Input.stick_button = keys[K_BACKSLASH]
-        Input.primary = keys[K_k] or keys[K_SPACE]
-        Input.secondary = keys[K_l] or keys[K_e] or keys[K_SLASH] or keys[K_KP_PLUS]
-        Input.x = keys[K_j]
-        Input.y = keys[K_i]
-        Input.l = keys[K_u]
-        Input.r = keys[K_o]
-        Input.l2 = False
-        Input.r2 = False
-        Input.start = keys[K_RETURN] or keys[K_KP_ENTER]
-        Input.select = keys[K_TAB]
-        Input.escape = keys[K_ESCAPE]
-        Input.reset = keys[K_r]
-        for name, device in Input.button_instances.items():
-            if not getattr(Input, name):
-                setattr(Input, name, device.is_pressed)
+        try:
+            if hasattr(pygame, "SYSTEM_CURSOR_ARROW"):
+                if shown: pygame.mouse.set_cursor(SYSTEM_CURSOR_ARROW)
+                else: pygame.mouse.set_cursor((8,8),(0,0),(0,0,0,0,0,0,0,0),(0,0,0,0,0,0,0,0))
+            else:
+                pygame.mouse.set_visible(shown)
+        except pygame.error: # no cursor support (such as the dummy video driver)
+            pass
+
+    @staticmethod
+    def update():
+        if Input.held_changed:
+            Input.held_changed = False # before reading, so a callback that comes in meanwhile is seen next time
+            held = 0
+            for key in tuple(Input.held_keys):
+                held |= Input.bits[Input.key_map[key]]
+            for name in tuple(Input.held_buttons):
+                held |= Input.bits[name]
+            Input.held_mask = held
+        mask = Input.held_mask
         if RASPBERRY_PI:
-            jx, jy = Input.get_joystick()
-            Input.stick_position = (jx, jy)
-            Input.stick_amount = math.sqrt(jx*jx+jy*jy)
-            Input.stick_angle = math.degrees(math.atan2(jy, jx))
-            if Input.stick_angle < 0: Input.stick_angle += 360
-            if Input.stick_amount > Input.joystick_deadzone:
-                overlap = 60
-                if not Input.right and (Input.stick_angle < overlap or Input.stick_angle > 360-overlap): Input.right = True
-                if not Input.up and 90-overlap < Input.stick_angle < 90+overlap: Input.up = True
-                if not Input.left and 180-overlap < Input.stick_angle < 180+overlap: Input.left = True
-                if not Input.down and 270-overlap < Input.stick_angle < 270+overlap: Input.down = True
-        else:
-            jx, jy = Input.right-Input.left, Input.up-Input.down
+            Input.stick_position, Input.stick_amount, Input.stick_angle, directions = Input.stick_snapshot
+            mask |= directions
+        if mask & Input.button_bits: mask |= Input.bits["any_button"]
+        if mask & Input.direction_bits: mask |= Input.bits["any_direction"]
+        prev = Input.mask
+        if not RASPBERRY_PI and (mask ^ prev) & Input.direction_bits:
+            jx = (mask & Input.bits["right"] != 0)-(mask & Input.bits["left"] != 0)
+            jy = (mask & Input.bits["up"] != 0)-(mask & Input.bits["down"] != 0)
             Input.stick_position = (jx*Input.joystick_radius, jy*Input.joystick_radius)
             Input.stick_amount = Input.joystick_radius if jx != 0 or jy != 0 else 0
             Input.stick_angle = math.degrees(math.atan2(jy, jx))
-        Input.any_button = any([
-            Input.primary, Input.secondary, Input.start, Input.x, Input.y,
-            Input.select, Input.escape, Input.reset
-        ])
-        Input.any_direction = any([Input.left, Input.right, Input.up, Input.down])
+        Input.apply_mask(mask)
+        if InputRecording.mode is not None:
+            InputRecording.process()
+
+    @staticmethod
+    def apply_mask(mask): # only the inputs that changed are set
+        changed = mask ^ Input.mask
+        if changed:
+            for name, bit in Input.bits.items():
+                if changed & bit: setattr(Input, name, mask & bit != 0)
+        Input.mask = mask
 
     @staticmethod
     def rate_limit(new, old, limit):
@@ -217,28 +311,65 @@ class Input(object):
         return min(max(new, old-limit), old+limit)
     
     @staticmethod
-    def update_hardware(rate_limit=1, force=False):
-        elapsed = time.perf_counter()-Input.last_hardware_update
-        if not force:
-            if elapsed < 0.5: return False
-            if elapsed > 0.75: rate_limit = None 
-        Input.last_hardware_update = time.perf_counter()
+    def read_hardware(prev, rate_limit=1):
+        battery_percent, battery_charging, cpu_temp, memory_usage = prev
         try:
             if Input._bus is not None:
                 bat = Input._bus.read_byte_data(0x57, 0x2a)
-                Input.battery_percent = Input.rate_limit(bat, Input.battery_percent, rate_limit)
-                Input.battery_charging = Input._bus.read_byte_data(0x57, 0x02) >> 7 & 1 == 1
+                battery_percent = Input.rate_limit(bat, battery_percent, rate_limit)
+                battery_charging = Input._bus.read_byte_data(0x57, 0x02) >> 7 & 1 == 1
             if Input._embpi is not None:
-                Input.cpu_temp = Input._embpi.get_cpu_temp()
+                cpu_temp = Input._embpi.get_cpu_temp()
                 ram = Input._embpi.get_ram_info()
-                Input.memory_usage = float(ram[1])/float(ram[0])*100
+                memory_usage = float(ram[1])/float(ram[0])*100
             if Input._psutil is not None and not RASPBERRY_PI:
                 bat = Input._psutil.sensors_battery()
-                Input.battery_percent = bat.percent
-                Input.battery_charging = bat.power_plugged
-                Input.memory_usage = math.ceil(Input._psutil.virtual_memory().percent)
+                if bat is not None:
+                    battery_percent = bat.percent
+                    battery_charging = bat.power_plugged
+                memory_usage = math.ceil(Input._psutil.virtual_memory().percent)
         except OSError:
             pass
+        return battery_percent, battery_charging, cpu_temp, memory_usage
+
+    @staticmethod
+    def start_hardware_sampler(interval=0.5):
+        if Input._sampler is not None: return
+        if Input._bus is None and Input._embpi is None and Input._psutil is None: return
+        def thread():
+            last = 0
+            while not Input._sampler_stop.is_set():
+                now = time.perf_counter()
+                if now-Input.last_hardware_request < 1: # only sample while something is showing the readings
+                    rate_limit = None if now-last > 0.75 else 1
+                    Input.hardware_snapshot = Input.read_hardware(Input.hardware_snapshot, rate_limit)
+                    last = now
+                Input._sampler_stop.wait(interval)
+        Input._sampler_stop = threading.Event()
+        Input._sampler = threading.Thread(target=thread, daemon=True)
+        Input._sampler.start()
+
+    @staticmethod
+    def stop_hardware_sampler():
+        if Input._sampler is None: return
+        Input._sampler_stop.set()
+        Input._sampler = None
+
+    @staticmethod
+    def update_hardware(rate_limit=1, force=False):
+        if Input._sampler is not None: # readings are taken by the sampler thread, just publish its latest snapshot
+            Input.last_hardware_request = time.perf_counter()
+            snapshot = Input.hardware_snapshot
+            changed = snapshot != (Input.battery_percent, Input.battery_charging, Input.cpu_temp, Input.memory_usage)
+            Input.battery_percent, Input.battery_charging, Input.cpu_temp, Input.memory_usage = snapshot
+            return changed
+        elapsed = time.perf_counter()-Input.last_hardware_update
+        if not force:
+            if elapsed < 0.5: return False
+            if elapsed > 0.75: rate_limit = None 
+        Input.last_hardware_update = time.perf_counter()
+        Input.hardware_snapshot = Input.read_hardware(Input.hardware_snapshot, rate_limit)
+        Input.battery_percent, Input.battery_charging, Input.cpu_temp, Input.memory_usage = Input.hardware_snapshot
         return True
     
     @staticmethod
@@ -246,6 +377,111 @@ class Input(object):
         return {name: getattr(Input, name) for name in Input.keys}
 
 
+class InputRecording: # per step input snapshots and an rng seed, so a run can be replayed exactly
+    mode = None # "record" or "replay"
+    file = None
+    seed = None
+    slot = None # save slot the run was started with
+    keys = [] # key name per bit of the recorded key masks
+    frames = [] # [key mask, stick x, stick y, stick amount, stick angle, repeat count]
+    settings = None # settings that change the simulation, as they were when recording started
+    recorded_settings = ["low_detail", "reduce_motion", "enable_transparency", "max_particles", "max_particles_per_step"]
+    index = 0
+    repeat = 0
+    finished = False
+
+    @staticmethod
+    def start_recording(fn, seed=None, slot=None):
+        if seed is None: seed = random.randrange(2**32)
+        InputRecording.mode = "record"
+        InputRecording.file = fn
+        InputRecording.seed = seed
+        InputRecording.slot = slot
+        InputRecording.keys = Input.keys[:]
+        InputRecording.frames = []
+        InputRecording.settings = None # taken at the first step, settings aren't loaded yet
+        InputRecording.finished = False
+        random.seed(seed)
+
+    @staticmethod
+    def start_replay(fn):
+        with open(fn) as f:
+            InputRecording.start_replay_data(json.load(f), fn)
+
+    @staticmethod
+    def start_replay_data(data, fn=None): # replays an already loaded (or generated) recording
+        InputRecording.restore_settings()
+        InputRecording.mode = "replay"
+        InputRecording.file = fn
+        InputRecording.seed = data["seed"]
+        InputRecording.slot = data.get("slot")
+        InputRecording.keys = data["keys"]
+        InputRecording.frames = data["frames"]
+        InputRecording.settings = data.get("settings") or {} # older recordings play with the current settings
+        for k, v in InputRecording.settings.items():
+            Settings.override(k, v)
+        InputRecording.index, InputRecording.repeat = 0, 0
+        InputRecording.finished = len(InputRecording.frames) == 0
+        random.seed(InputRecording.seed)
+
+    @staticmethod
+    def restore_settings():
+        if InputRecording.mode == "replay" and InputRecording.settings:
+            Settings.clear_overrides(InputRecording.settings)
+
+    @staticmethod
+    def take_settings():
+        return {k: Settings.get(k) for k in InputRecording.recorded_settings}
+
+    @staticmethod
+    def snapshot():
+        mask = Input.mask # recordings are always made with Input.keys
+        return [mask, Input.stick_position[0], Input.stick_position[1], Input.stick_amount, Input.stick_angle]
+
+    @staticmethod
+    def process():
+        if InputRecording.mode == "record":
+            if InputRecording.settings is None: InputRecording.settings = InputRecording.take_settings()
+            snapshot = InputRecording.snapshot()
+            if InputRecording.frames and InputRecording.frames[-1][:-1] == snapshot: # run length encoded
+                InputRecording.frames[-1][-1] += 1
+            else:
+                InputRecording.frames.append(snapshot+[1])
+        elif InputRecording.mode == "replay":
+            if InputRecording.finished: # out of recorded input, hand control back
+                InputRecording.restore_settings()
+                InputRecording.mode = None
+                return
+            mask, x, y, amount, angle, count = InputRecording.frames[InputRecording.index]
+            if InputRecording.keys != Input.keys: # recorded with other inputs, move the bits to where they are now
+                mask = sum(Input.bits[name] for i, name in enumerate(InputRecording.keys) if mask >> i & 1 and name in Input.bits)
+            Input.apply_mask(mask)
+            Input.stick_position = (x, y)
+            Input.stick_amount, Input.stick_angle = amount, angle
+            InputRecording.repeat += 1
+            if InputRecording.repeat >= count:
+                InputRecording.index += 1
+                InputRecording.repeat = 0
+                InputRecording.finished = InputRecording.index >= len(InputRecording.frames)
+
+    @staticmethod
+    def stop(): # writes the recording
+        if InputRecording.mode == "record" and InputRecording.file is not None:
+            if os.path.dirname(InputRecording.file):
+                os.makedirs(os.path.dirname(InputRecording.file), exist_ok=True)
+            with open(InputRecording.file, "w") as f:
+                json.dump({
+                    "version": 1,
+                    "seed": InputRecording.seed,
+                    "slot": InputRecording.slot,
+                    "keys": InputRecording.keys,
+                    "settings": InputRecording.settings or InputRecording.take_settings(),
+                    "frames": InputRecording.frames
+                }, f, separators=(",", ":"))
+        InputRecording.restore_settings()
+        InputRecording.mode = None
+
+
 ## SETTINGS ##
 
 class SettingsBase(object):
@@ -254,6 +490,7 @@ class SettingsBase(object):
     default_preset = None
     presets = {}
     all = []
+    saved = {} # what overridden settings are set to otherwise, written by save() instead of the override
 
     @classmethod
     def get(cls, key):
@@ -261,18 +498,37 @@ class SettingsBase(object):
     
     @classmethod
     def set(cls, key, value):
+        cls.saved.pop(key, None) # a setting that's changed explicitly is no longer overridden
+        setattr(cls, key, value)
+        cls.update_extras()
+
+    @classmethod
+    def override(cls, key, value): # changes a setting for this run only, it's never saved
+        if key not in cls.saved: cls.saved[key] = cls.get(key)
         setattr(cls, key, value)
         cls.update_extras()
+
+    @classmethod
+    def clear_overrides(cls, keys=None):
+        for key in list(cls.saved if keys is None else keys):
+            if key in cls.saved: setattr(cls, key, cls.saved.pop(key))
+        cls.update_extras()
     
     @classmethod
     def update_extras(cls):
         pass
     
     @classmethod
-    def apply_preset(cls, name):
+    def load_value(cls, key, value): # overridden settings keep their override
+        if key in cls.saved: cls.saved[key] = value
+        else: cls.set(key, value)
+
+    @classmethod
+    def apply_preset(cls, name, keep_overrides=False):
         assert name in cls.presets
         for k, v in cls.presets[name].items():
-            cls.set(k, v)
+            if keep_overrides: cls.load_value(k, v)
+            else: cls.set(k, v)
         cls.last_preset = name
     
     @classmethod
@@ -285,7 +541,7 @@ class SettingsBase(object):
     def save(cls):
         if cls.save_file is None: return False
         os.makedirs(os.path.dirname(cls.save_file), exist_ok=True)
-        attrs = {k: cls.get(k) for k in cls.all}
+        attrs = {k: cls.saved.get(k, cls.get(k)) for k in cls.all}
         with open(cls.save_file, "w") as f:
             json.dump(attrs, f, indent=2)
         return True
@@ -296,7 +552,7 @@ class SettingsBase(object):
         with open(cls.save_file) as f:
             attrs = json.load(f)
         for k, v in attrs.items():
-            cls.set(k, v)
+            cls.load_value(k, v)
         return True
     
     @classmethod
@@ -305,10 +561,11 @@ class SettingsBase(object):
             if cls.default_preset is None: return
             preset = cls.default_preset
         if not cls.load():
-            cls.apply_preset(preset)
+            cls.apply_preset(preset, keep_overrides=True)
 
 
 class Settings(SettingsBase):
+    saved = {} # own overrides, not shared with other SettingsBase classes
     presets = {
         "low": {
             "low_detail": True,
@@ -341,6 +598,7 @@ class Settings(SettingsBase):
         "volume_music": "Music volume",
         "volume_sfx": "SFX volume",
         "show_hitboxes": "Show hitboxes",
+        "adaptive_quality": "Adaptive quality",
     }
     all = [
         "windowed",
@@ -354,6 +612,10 @@ class Settings(SettingsBase):
         "volume_music",
         "volume_sfx",
         "show_hitboxes",
+        "adaptive_quality",
+        "max_particles",
+        "max_particles_per_step",
+        "threaded_render",
         "joystick_calibration"
     ]
 
@@ -368,12 +630,20 @@ class Settings(SettingsBase):
     volume_music = 1 if RASPBERRY_PI else 0.2
     volume_sfx = 1 if RASPBERRY_PI else 0.2
     show_hitboxes = False
+    adaptive_quality = False
+    max_particles = 200 if RASPBERRY_PI else 400 # cosmetic particles are dropped first when there's no room
+    max_particles_per_step = 24 if RASPBERRY_PI else 48
+    threaded_render = False # replay draw calls on a second thread, a frame behind the simulation
     joystick_calibration = [
         0, Input.joystick_radius, Input.joystick_radius*2, # min x, mid x, max x
         0, Input.joystick_radius, Input.joystick_radius*2  # min y, mid y, max y
     ]
     default_preset = "medium"
 
+    @classmethod
+    def update_extras(cls):
+        QualityGovernor.enable(cls.adaptive_quality)
+
 
 ## MUSIC ##
 
@@ -385,6 +655,7 @@ class MusicManager:
     loop_end = None
     crossfade_finish = None
     fade_time = 0.3
+    muted = False # never touch the mixer (headless mode)
     
     @staticmethod
     def load_loop_data(fn):
@@ -398,6 +669,7 @@ class MusicManager:
 
     @staticmethod
     def play_queued(sync=True):
+        if MusicManager.muted: return
         def thread():
             if Settings.volume_music == 0: return
             while pygame.mixer.get_init() is None: pass
@@ -409,10 +681,12 @@ class MusicManager:
 
     @staticmethod
     def fade_out():
+        if MusicManager.muted: return
         pygame.mixer.music.fadeout(int(MusicManager.fade_time*1000))
     
     @staticmethod
     def set_volume(volume):
+        if MusicManager.muted: return
         pygame.mixer.music.set_volume(volume)
 
     @staticmethod
@@ -429,7 +703,7 @@ class MusicManager:
             MusicManager.loop_start, MusicManager.loop_end = MusicManager.loop_data[stripped]
         else:
             MusicManager.loop_start, MusicManager.loop_end = 0, None
-        if MusicManager.name is None or MusicManager.crossfade_finish is not None or \
+        if MusicManager.name is None or MusicManager.crossfade_finish is not None or MusicManager.muted or \
             pygame.mixer.music.get_pos() <= MusicManager.fade_time:
             MusicManager.name = name
             MusicManager.play_queued(sync=True)
@@ -441,7 +715,8 @@ class MusicManager:
 
     @staticmethod
     def stop():
-        if PYGAME_2: pygame.mixer.music.unload()
+        if MusicManager.muted: pass
+        elif PYGAME_2: pygame.mixer.music.unload()
         else: pygame.mixer.music.stop()
         MusicManager.name = None
         MusicManager.loop_num = 0
@@ -449,6 +724,7 @@ class MusicManager:
 
     @staticmethod
     def update():
+        if MusicManager.muted: return
         if MusicManager.crossfade_finish is not None:
             if time.perf_counter() >= MusicManager.crossfade_finish:
                 MusicManager.play_queued(sync=False)
@@ -569,6 +845,9 @@ class Fontsheet:
         self.height = height
         self.sprites = {}
         self.char_widths = {}
+        self.render_cache = Cache(256) # rendered text per (text, upper), shared so copy before modifying
+        self.width_cache = Cache(1024) # text widths per (text, upper)
+        self.advances = None
         self.set_char_widths(.66, " .,!")
         self.unknown_char = "?"
 
@@ -588,6 +867,7 @@ class Fontsheet:
         if len(self.sprites) == 0:
             self.tilew, self.tileh = surface.get_size()
         self.sprites[char] = surface
+        self.clear_cache()
 
     def get(self, char, upper=True):
         char = str(char)
@@ -602,25 +882,50 @@ class Fontsheet:
     def set_char_widths(self, width, chars):
         for char in chars:
             self.char_widths[char] = width
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.render_cache.clear()
+        self.width_cache.clear()
+        self.advances = None
+
+    def update_advances(self): # integer x advance per character
+        self.default_advance = math.floor(self.tilew)
+        self.advances = {char: math.floor(width*self.tilew) for char, width in self.char_widths.items()}
 
     def get_width(self, text, upper=True):
+        return self.width_cache.get((text, upper), lambda: self.measure(text, upper))
+
+    def measure(self, text, upper=True):
+        if self.advances is None: self.update_advances()
         if upper: text = text.upper()
-        return sum(math.floor(self.char_widths.get(char, 1)*self.tilew) for char in text)
-    
-    def render(self, text, **kwargs):
-        if len(text) == 0: return Assets.sized_surface(1, self.tileh)
+        return sum(self.advances.get(char, self.default_advance) for char in text)
+
+    def layout(self, text, upper=True): # returns [(glyph, (x, y))] and the size of the rendered text
+        if self.advances is None: self.update_advances()
+        if upper: text = text.upper()
+        advances, default_advance = self.advances, self.default_advance
+        unknown = self.get(self.unknown_char, upper)
         lines = text.split("\n")
-        surface = Assets.sized_surface(math.ceil(max(self.get_width(ln, **kwargs) for ln in lines)), len(lines)*self.tileh)
-        y = 0
-        for ln in lines:
-            x = math.floor(surface.get_width()/2-self.get_width(ln, **kwargs)/2)
+        widths = [sum(advances.get(char, default_advance) for char in ln) for ln in lines]
+        width = max(widths)
+        glyphs = []
+        for ln, ln_width, y in zip(lines, widths, range(0, len(lines)*self.tileh, self.tileh)):
+            x = math.floor(width/2-ln_width/2)
             for char in ln:
-                render = self.get(char, **kwargs)
-                if render is None: render = self.get(self.unknown_char, **kwargs)
-                if render is None: continue
-                surface.blit(render, (x, y))
-                x += self.get_width(char, **kwargs)
-            y += self.tileh
+                glyph = self.sprites.get(char, unknown)
+                if glyph is not None: glyphs.append((glyph, (x, y)))
+                x += advances.get(char, default_advance)
+        return glyphs, (width, len(lines)*self.tileh)
+    
+    def render(self, text, upper=True):
+        return self.render_cache.get((text, upper), lambda: self.render_uncached(text, upper))
+
+    def render_uncached(self, text, upper=True):
+        if len(text) == 0: return Assets.sized_surface(1, self.tileh)
+        glyphs, size = self.layout(text, upper)
+        surface = Assets.sized_surface(size)
+        surface.blits(glyphs, doreturn=False)
         return surface
 
 
@@ -647,12 +952,94 @@ class Collection:
         return self.items.get(name, df)
 
 
+class Cache: # least recently used items are evicted once max_size is exceeded
+    def __init__(self, max_size=None):
+        self.items = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+    
+    def __repr__(self):
+        return f"<{self.__class__.__name__}[{len(self.items)}/{self.max_size}](hits={self.hits}, misses={self.misses})>"
+
+    def get(self, key, factory=None):
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        self.misses += 1
+        if factory is None: return None
+        return self.set(key, factory())
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while self.max_size is not None and len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return value
+
+    def pop(self, key):
+        return self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+
+class VariantPool(Cache): # up to size interchangeable variants per key, picked at random
+    def __init__(self, size, max_size=None, max_pixels=None):
+        super().__init__(max_size)
+        self.size = size
+        self.max_pixels = max_pixels # total surface area of all variants, the least recently used keys are dropped first
+        self.pixels = 0
+
+    def get_variant(self, key, factory, grow=True):
+        variants = self.get(key, list)
+        if len(variants) == 0 or (grow and len(variants) < self.size):
+            variant = factory()
+            variants.append(variant)
+            self.pixels += variant.get_width()*variant.get_height()
+            self.trim()
+            return variant
+        return random.choice(variants)
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        self.trim()
+        return value
+
+    def trim(self): # never drops the key used last
+        while len(self.items) > 1 and (
+            (self.max_size is not None and len(self.items) > self.max_size) or
+            (self.max_pixels is not None and self.pixels > self.max_pixels)
+            ):
+            _, variants = self.items.popitem(last=False)
+            self.pixels -= sum(variant.get_width()*variant.get_height() for variant in variants)
+
+    def pop(self, key):
+        variants = self.items.pop(key, None)
+        if variants is not None:
+            self.pixels -= sum(variant.get_width()*variant.get_height() for variant in variants)
+        return variants
+
+    def clear(self):
+        super().clear()
+        self.pixels = 0
+
+
 class Assets(object):
     asset_dir = os.getcwd()+os.sep
     debug_font = None
     status_font = None
     status_icons = None
     status_modules = ["time", "battery", "cpu"]
+    status_cache = None # (key, surface) of the last status indicator, rebuilt when the shown values change
 
     @staticmethod
     def init():
@@ -821,12 +1208,9 @@ class Assets(object):
         return im
     
     @staticmethod
-    def status_indicator(rjust=False):
-        surface = Assets.sized_surface(96, 20*len(Assets.status_modules))
-        iy = 0
-        for i, name in enumerate(Assets.status_modules):
-            ix = surface.get_width()-18-4 if rjust else 4
-            tx, ty = ix-5 if rjust else ix+18+5, iy+3
+    def status_entries():
+        entries = [] # (icon, text) per shown module
+        for name in Assets.status_modules:
             icon, text = None, None
             if name == "time":
                 text = time.strftime("%H:%M")
@@ -849,6 +1233,19 @@ class Assets(object):
                 if Input.memory_usage > 40: icon += 1
                 if Input.memory_usage > 80: icon += 1
                 text = f"{math.ceil(Input.memory_usage)}%"
+            entries.append((icon, text))
+        return tuple(entries)
+
+    @staticmethod
+    def status_indicator(rjust=False):
+        key = (rjust, Assets.status_entries())
+        if Assets.status_cache is not None and Assets.status_cache[0] == key:
+            return Assets.status_cache[1]
+        surface = Assets.sized_surface(96, 20*len(Assets.status_modules))
+        iy = 0
+        for icon, text in key[1]:
+            ix = surface.get_width()-18-4 if rjust else 4
+            tx, ty = ix-5 if rjust else ix+18+5, iy+3
             if icon is not None:
                 icon = Assets.status_icons[icon]
                 surface.blit(icon, (ix, iy))
@@ -860,12 +1257,509 @@ class Assets(object):
             iy += 20
         if iy < surface.get_height():
             surface = surface.subsurface(0, 0, surface.get_width(), iy)
+        Assets.status_cache = (key, surface)
         return surface
 
 
+## PROFILING ##
+
+class StartupTrace:
+    enabled = False
+    origin = _import_time # measured from when lib was first imported
+    output_file = None
+    spans = [] # [name, depth, start, end, thread name]
+    local = threading.local() # nesting depth per thread, spans on other threads are only nested in their own
+    first_frame = None
+    first_frame_label = "first frame" # "first step" in headless mode, where nothing is drawn
+
+    @staticmethod
+    def enable(output_file=None):
+        StartupTrace.enabled = True
+        StartupTrace.output_file = output_file
+
+    @staticmethod
+    @contextmanager
+    def span(name):
+        if not StartupTrace.enabled or StartupTrace.first_frame is not None:
+            yield
+            return
+        depth = getattr(StartupTrace.local, "depth", 0)
+        thread = threading.current_thread()
+        span = [name, depth, time.perf_counter(), None, None if thread is threading.main_thread() else thread.name]
+        StartupTrace.spans.append(span)
+        StartupTrace.local.depth = depth+1
+        try:
+            yield
+        finally:
+            StartupTrace.local.depth = depth
+            span[3] = time.perf_counter()
+
+    @staticmethod
+    def mark_first_frame(label="first frame"):
+        if not StartupTrace.enabled or StartupTrace.first_frame is not None: return
+        StartupTrace.first_frame = time.perf_counter()
+        StartupTrace.first_frame_label = label
+        print(StartupTrace.report())
+        if StartupTrace.output_file is not None:
+            StartupTrace.save(StartupTrace.output_file)
+
+    @staticmethod
+    def to_json():
+        ms = lambda t: None if t is None else round((t-StartupTrace.origin)*1000, 3)
+        return {
+            "spans": [
+                {"name": name, "depth": depth, "start": ms(start),
+                 "duration": None if end is None else round((end-start)*1000, 3),
+                 "thread": thread, "running": end is None} # still running when the report was written
+                for name, depth, start, end, thread in list(StartupTrace.spans)
+            ],
+            "first_frame": ms(StartupTrace.first_frame),
+            "first_frame_label": StartupTrace.first_frame_label,
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver
+        }
+
+    @staticmethod
+    def report():
+        data = StartupTrace.to_json()
+        lines = ["Startup trace (ms)", f"{'span':<44}{'start':>10}{'duration':>10}"]
+        for span in data["spans"]:
+            name = "  "*span["depth"]+span["name"]
+            if span["thread"] is not None: name += f" [{span['thread']}]"
+            duration = "running" if span["running"] else f"{span['duration']:.1f}"
+            lines.append(f"{name:<44}{span['start']:>10.1f}{duration:>10}")
+        if data["first_frame"] is not None:
+            lines.append(f"{'time to '+data['first_frame_label']:<44}{data['first_frame']:>20.1f}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def save(fn):
+        if os.path.dirname(fn): os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "w") as f:
+            json.dump(StartupTrace.to_json(), f, indent=2)
+
+
+class FrameTimer: # per phase durations of recent frames, drawn as a rolling graph and optionally written to csv
+    enabled = False # only measured while the graph is shown or a csv is written
+    show_graph = False
+    phases = [] # "name" or "parent.name", set by the game controller
+    colors = [(255, 96, 96), (96, 200, 255), (255, 200, 64), (128, 255, 128), (208, 128, 255), (255, 255, 255)]
+    current = {} # seconds per phase in the frame being measured
+    history = deque(maxlen=200)
+    frames = 0
+    graph = None
+    legend = None
+    graph_size = (200, 64)
+    ms_height = 3 # pixels per ms in the graph
+    budget = 1000/60 # ms, marked in the graph
+    csv_file = None
+    csv_handle = None
+    csv_writer = None
+    csv_start = 0
+    null_phase = nullcontext()
+
+    @staticmethod
+    def update_enabled():
+        FrameTimer.enabled = FrameTimer.show_graph or FrameTimer.csv_writer is not None
+        if not FrameTimer.enabled: FrameTimer.current = {}
+
+    @staticmethod
+    def toggle_graph(show=None):
+        FrameTimer.show_graph = not FrameTimer.show_graph if show is None else show
+        FrameTimer.history.clear()
+        FrameTimer.graph, FrameTimer.legend = None, None
+        FrameTimer.update_enabled()
+
+    @staticmethod
+    def start_csv(fn):
+        FrameTimer.stop_csv()
+        if os.path.dirname(fn): os.makedirs(os.path.dirname(fn), exist_ok=True)
+        FrameTimer.csv_file = fn
+        FrameTimer.csv_handle = open(fn, "w", newline="")
+        FrameTimer.csv_writer = csv.writer(FrameTimer.csv_handle)
+        FrameTimer.csv_writer.writerow(["frame", "time"]+[name+"_ms" for name in FrameTimer.phases])
+        FrameTimer.csv_start = time.perf_counter()
+        FrameTimer.update_enabled()
+
+    @staticmethod
+    def stop_csv():
+        if FrameTimer.csv_handle is not None:
+            FrameTimer.csv_handle.close()
+        FrameTimer.csv_file, FrameTimer.csv_handle, FrameTimer.csv_writer = None, None, None
+        FrameTimer.update_enabled()
+
+    @staticmethod
+    def phase(name):
+        if not FrameTimer.enabled: return FrameTimer.null_phase # no generator per call while off
+        return FrameTimer.span(name)
+
+    @staticmethod
+    @contextmanager
+    def span(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            FrameTimer.current[name] = FrameTimer.current.get(name, 0)+time.perf_counter()-start
+
+    @staticmethod
+    def end_frame():
+        if not FrameTimer.enabled: return
+        frame, FrameTimer.current = FrameTimer.current, {}
+        FrameTimer.frames += 1
+        if FrameTimer.show_graph:
+            FrameTimer.history.append(frame)
+            FrameTimer.plot(frame)
+        if FrameTimer.csv_writer is not None:
+            FrameTimer.csv_writer.writerow(
+                [FrameTimer.frames, round(time.perf_counter()-FrameTimer.csv_start, 4)] +
+                [round(frame.get(name, 0)*1000, 3) for name in FrameTimer.phases]
+            )
+
+    @staticmethod
+    def top_phases():
+        return [name for name in FrameTimer.phases if not "." in name]
+
+    @staticmethod
+    def plot(frame): # scrolls the graph by one column and stacks the top level phases in the new one
+        w, h = FrameTimer.graph_size
+        if FrameTimer.graph is None:
+            FrameTimer.graph = Assets.sized_surface(FrameTimer.graph_size)
+            FrameTimer.graph.fill((0, 0, 0, 160))
+        FrameTimer.graph.scroll(-1, 0)
+        FrameTimer.graph.fill((0, 0, 0, 160), (w-1, 0, 1, h))
+        y = h
+        for i, name in enumerate(FrameTimer.top_phases()):
+            px = round(frame.get(name, 0)*1000*FrameTimer.ms_height)
+            if px > 0: FrameTimer.graph.fill(FrameTimer.colors[i%len(FrameTimer.colors)], (w-1, y-px, 1, px))
+            y -= px
+        FrameTimer.graph.set_at((w-1, h-round(FrameTimer.budget*FrameTimer.ms_height)), GRAY)
+        if FrameTimer.legend is None or FrameTimer.frames % 30 == 0:
+            FrameTimer.render_legend()
+
+    @staticmethod
+    def render_legend(): # mean ms per phase over the graph's history
+        top = FrameTimer.top_phases()
+        w = FrameTimer.graph_size[0]
+        FrameTimer.legend = Assets.sized_surface(w, len(FrameTimer.phases)*14+4)
+        FrameTimer.legend.fill((0, 0, 0, 160))
+        for i, name in enumerate(FrameTimer.phases):
+            color = GRAY if "." in name else FrameTimer.colors[top.index(name)%len(FrameTimer.colors)]
+            mean = sum(frame.get(name, 0) for frame in FrameTimer.history)/max(len(FrameTimer.history), 1)
+            label = Assets.debug_font.render(name.split(".")[-1], False, color)
+            value = Assets.debug_font.render(f"{mean*1000:.2f}", False, color)
+            FrameTimer.legend.blit(label, (3+10*name.count("."), 2+i*14))
+            FrameTimer.legend.blit(value, (w-3-value.get_width(), 2+i*14))
+
+    @staticmethod
+    def draw(surface): # top right corner
+        if not FrameTimer.show_graph or FrameTimer.graph is None: return
+        x = surface.get_width()-FrameTimer.graph_size[0]-3
+        graph = FrameTimer.graph.copy() if isinstance(surface, DisplayList) else FrameTimer.graph # scrolled before it's replayed
+        surface.blit(graph, (x, 3))
+        return surface.blit(FrameTimer.legend, (x, 3+FrameTimer.graph_size[1]))
+
+
+class SamplingProfiler: # samples the stack of one thread from a background thread, nothing runs while stopped
+    interval = 0.005 # seconds between samples
+    thread = None
+    stop_event = None
+    output_file = None
+    samples = {} # sample count per collapsed stack, "file:function;file:function;..."
+    sample_count = 0
+    labels = {} # "file:function" per code object
+
+    @staticmethod
+    def running():
+        return SamplingProfiler.thread is not None
+
+    @staticmethod
+    def start(fn, duration=None, thread_id=None): # profiles the calling thread unless another is given
+        if SamplingProfiler.running(): return
+        target = threading.get_ident() if thread_id is None else thread_id
+        SamplingProfiler.output_file = fn
+        SamplingProfiler.samples = {}
+        SamplingProfiler.sample_count = 0
+        SamplingProfiler.stop_event = threading.Event()
+        SamplingProfiler.thread = threading.Thread(
+            target=SamplingProfiler.run, args=(target, duration, SamplingProfiler.stop_event), daemon=True
+        )
+        SamplingProfiler.thread.start()
+        print(f"Profiling{'' if duration is None else f' for {duration}s'}, writing to {fn}")
+
+    @staticmethod
+    def stop():
+        thread = SamplingProfiler.thread
+        if thread is None: return
+        SamplingProfiler.stop_event.set()
+        if thread is not threading.current_thread(): thread.join()
+
+    @staticmethod
+    def run(target, duration, stop_event):
+        end = None if duration is None else time.perf_counter()+duration
+        while not stop_event.wait(SamplingProfiler.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None: break # thread is gone
+            stack = []
+            while frame is not None:
+                stack.append(SamplingProfiler.label(frame.f_code))
+                frame = frame.f_back
+            del frame
+            key = ";".join(reversed(stack))
+            SamplingProfiler.samples[key] = SamplingProfiler.samples.get(key, 0)+1
+            SamplingProfiler.sample_count += 1
+            if end is not None and time.perf_counter() >= end: break
+        SamplingProfiler.save(SamplingProfiler.output_file)
+        print(SamplingProfiler.report())
+        SamplingProfiler.thread = None
+
+    @staticmethod
+    def label(code):
+        if code not in SamplingProfiler.labels:
+            fn = code.co_filename
+            if os.path.isabs(fn) and os.path.abspath(fn).startswith(os.getcwd()+os.sep): # game code, relative
+                fn = os.path.relpath(fn)
+            else: # standard library and packages, the file name is enough
+                fn = os.path.basename(fn)
+            SamplingProfiler.labels[code] = f"{fn.replace(os.sep, '/')}:{code.co_name}"
+        return SamplingProfiler.labels[code]
+
+    @staticmethod
+    def report(limit=10): # functions the sampled thread spent the most time in, by their own code
+        total = max(SamplingProfiler.sample_count, 1)
+        own = {}
+        for stack, count in SamplingProfiler.samples.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            own[leaf] = own.get(leaf, 0)+count
+        lines = [f"Profile: {SamplingProfiler.sample_count} samples, every {SamplingProfiler.interval*1000:g} ms"]
+        for name, count in sorted(own.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f"{count/total*100:6.1f}%  {name}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def save(fn): # collapsed stacks, readable by flamegraph.pl and speedscope
+        if os.path.dirname(fn): os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "w") as f:
+            for stack, count in sorted(SamplingProfiler.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class QualityGovernor: # turns quality features down while frames miss their budget, and back up when there's headroom
+    enabled = False
+    features = ["shaders", "glitches", "particles", "transparency"] # turned down in this order, back up in reverse
+    reduced = [] # features currently turned down
+    window = 60 # frames per decision
+    slow = 0.9 # turn down when the 90th percentile frame takes longer than this much of the budget
+    fast = 0.5 # turn back up after up_windows windows in a row below this much of the budget
+    up_windows = 5
+    backoff = 1 # up_windows multiplier, doubled whenever a feature that was turned back up is too slow again
+    cooldown = 2 # windows without a decision after each change
+    particle_scale = 0.25 # part of the particle budget kept while particles are turned down
+    samples = []
+    windows = 0
+    fast_windows = 0
+    wait = 0
+    last_restore = None # window a feature was last turned back up in
+    start = time.perf_counter()
+    log = [] # (seconds since start, "reduce" or "restore", feature, 90th percentile ms, budget ms)
+    log_file = None
+
+    @staticmethod
+    def enable(enabled=True):
+        if enabled == QualityGovernor.enabled: return
+        QualityGovernor.enabled = enabled
+        QualityGovernor.reduced = []
+        QualityGovernor.samples = []
+        QualityGovernor.fast_windows, QualityGovernor.wait = 0, 0
+        QualityGovernor.backoff = 1
+
+    @staticmethod
+    def allows(feature): # whether a feature should be used in full, both by the settings and the governor
+        if feature in QualityGovernor.reduced: return False
+        if feature == "shaders": return Settings.enable_shaders
+        if feature in ("glitches", "particles"): return not Settings.low_detail
+        if feature == "transparency": return Settings.enable_transparency
+        return True
+
+    @staticmethod
+    def particle_budget(limit): # particles are turned down by shrinking their budget
+        if "particles" in QualityGovernor.reduced: return int(limit*QualityGovernor.particle_scale)
+        return limit
+
+    @staticmethod
+    def frame(seconds, budget): # time spent working on a frame, without waiting for the clock or vsync
+        if not QualityGovernor.enabled: return
+        if InputRecording.mode is not None: return # turning glitches down would change the simulation
+        QualityGovernor.samples.append(seconds)
+        if len(QualityGovernor.samples) < QualityGovernor.window: return
+        samples = sorted(QualityGovernor.samples)
+        QualityGovernor.samples = []
+        QualityGovernor.windows += 1
+        p90 = samples[int(len(samples)*0.9)]
+        if QualityGovernor.wait > 0:
+            QualityGovernor.wait -= 1
+        elif p90 > budget*QualityGovernor.slow:
+            QualityGovernor.fast_windows = 0
+            for feature in QualityGovernor.features:
+                if QualityGovernor.allows(feature):
+                    if QualityGovernor.last_restore is not None and \
+                        QualityGovernor.windows-QualityGovernor.last_restore <= QualityGovernor.up_windows:
+                        QualityGovernor.backoff = min(QualityGovernor.backoff*2, 8) # don't flip flop
+                    QualityGovernor.reduced.append(feature)
+                    QualityGovernor.decide("reduce", feature, p90, budget)
+                    break
+        elif p90 < budget*QualityGovernor.fast and QualityGovernor.reduced:
+            QualityGovernor.fast_windows += 1
+            if QualityGovernor.fast_windows >= QualityGovernor.up_windows*QualityGovernor.backoff:
+                QualityGovernor.fast_windows = 0
+                QualityGovernor.last_restore = QualityGovernor.windows
+                QualityGovernor.decide("restore", QualityGovernor.reduced.pop(), p90, budget)
+        else:
+            QualityGovernor.fast_windows = 0
+
+    @staticmethod
+    def decide(action, feature, p90, budget):
+        QualityGovernor.wait = QualityGovernor.cooldown
+        entry = (
+            round(time.perf_counter()-QualityGovernor.start, 1), action, feature,
+            round(p90*1000, 2), round(budget*1000, 2)
+        )
+        QualityGovernor.log.append(entry)
+        line = f"[{entry[0]}s] quality governor: {action} {feature} (90th percentile frame {entry[3]} ms, budget {entry[4]} ms)"
+        print(line)
+        if QualityGovernor.log_file is not None:
+            if os.path.dirname(QualityGovernor.log_file):
+                os.makedirs(os.path.dirname(QualityGovernor.log_file), exist_ok=True)
+            with open(QualityGovernor.log_file, "a") as f:
+                f.write(line+"\n")
+
+
+class DisplayList: # stands in for the screen while rendering is threaded, records what is drawn so it can be replayed
+    BLIT, FILL, APPLY = range(3)
+
+    def __init__(self, size, renderer=None):
+        self.size = size
+        self.renderer = renderer
+        self.ops = []
+
+    def get_size(self):
+        return self.size
+
+    def get_width(self):
+        return self.size[0]
+
+    def get_height(self):
+        return self.size[1]
+
+    def blit(self, source, dest, area=None, special_flags=0):
+        # positions and alpha are copied, the objects that own them will have moved on by the time this is replayed
+        dest = (dest[0], dest[1])
+        if area is not None: area = pygame.Rect(area)
+        self.ops.append((DisplayList.BLIT, source, source.get_alpha(), dest, area, special_flags))
+        size = source.get_size() if area is None else area.size
+        return pygame.Rect(dest, size).clip((0, 0), self.size)
+
+    def fill(self, color, rect=None, special_flags=0):
+        if rect is not None: rect = pygame.Rect(rect)
+        self.ops.append((DisplayList.FILL, color, rect, special_flags))
+        return pygame.Rect((0, 0), self.size) if rect is None else rect.clip((0, 0), self.size)
+
+    def apply(self, func, *args, **kwargs): # func(surface, *args, **kwargs), a returned surface replaces the screen
+        self.ops.append((DisplayList.APPLY, func, args, kwargs))
+
+    def copy(self): # the last frame that was rendered, like the real screen between frames
+        return self.renderer.last_frame().copy()
+
+    def replay(self, surface):
+        for op in self.ops:
+            if op[0] == DisplayList.BLIT:
+                _, source, alpha, dest, area, special_flags = op
+                if source.get_alpha() != alpha: # faded again since, draw it as it was
+                    source = source.copy()
+                    source.set_alpha(alpha)
+                surface.blit(source, dest, area, special_flags)
+            elif op[0] == DisplayList.FILL:
+                surface.fill(op[1], op[2], op[3])
+            else:
+                result = op[1](surface, *op[2], **op[3])
+                if isinstance(result, pygame.Surface): surface = result
+        return surface
+
+
+class ThreadedRenderer: # replays each frame's DisplayList on its own thread, while the next frame is simulated
+    def __init__(self, create_canvas):
+        self.canvases = [create_canvas(), create_canvas()] # one drawn to, one presented
+        self.game_size = self.canvases[0].get_size()
+        self.outputs = [None, None] # scaled canvases
+        self.index = 0
+        self.pending = None # (display list, output size)
+        self.busy = False
+        self.finished = None # last rendered frame at output size
+        self.finished_canvas = None # and at game size
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running: return
+                display_list, output_size = self.pending
+                self.pending = None
+            canvas = display_list.replay(self.canvases[self.index])
+            if output_size == self.game_size:
+                frame = canvas
+            else:
+                if self.outputs[self.index] is None or self.outputs[self.index].get_size() != output_size:
+                    self.outputs[self.index] = pygame.Surface(output_size)
+                frame = pygame.transform.scale(canvas, output_size, self.outputs[self.index])
+            self.index = 1-self.index
+            with self.condition:
+                self.finished, self.finished_canvas = frame, canvas
+                self.busy = False
+                self.condition.notify_all()
+
+    def wait(self): # returns the last rendered frame once it's done, None before the first one
+        with self.condition:
+            while self.busy:
+                self.condition.wait()
+            return self.finished
+
+    def submit(self, display_list, output_size): # starts rendering a frame
+        self.wait()
+        with self.condition:
+            self.pending = (display_list, output_size)
+            self.busy = True
+            self.condition.notify_all()
+
+    def last_frame(self):
+        self.wait()
+        return self.finished_canvas if self.finished_canvas is not None else self.canvases[self.index]
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+
 ## GAMECONTROLLER ##
 
 class GameControllerBase:
+    tick_rate = 60 # simulation steps per second, independent of the rendered framerate
+    max_catch_up = 4 # most simulation steps run before a frame is drawn, the rest of a long stall is dropped
+    frame_phases = ["events", "update", "draw", "overlays", "scale", "display"] # measured by FrameTimer
+    headless = False # only simulate, without drawing to a window or playing audio
+    headless_steps = None # simulation steps run by mainloop in headless mode, None to run until stopped
+    profile_window = 10 # seconds profiled by SamplingProfiler when started with F5
+    profile_at = None # simulation step that starts the profiler by itself
+    renderer = None # ThreadedRenderer while rendering is threaded
+    screen_flags = 0 # of the screen surface, set by init_display
+
     def __init__(self):
         self.save_base = os.path.abspath("save")
         self.game_size = self.game_width, self.game_height = 800, 480
@@ -874,8 +1768,27 @@ class GameControllerBase:
         self.running = False
         self.buffer_touch_selection = False
         self.frame = 0
+        self.ticks = 0 # simulation steps since start, never reset
+
+    @classmethod
+    def enable_headless(cls): # call before pygame.init if possible, otherwise display and mixer are restarted
+        cls.headless = True
+        MusicManager.muted = True
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+        if pygame.display.get_init() and pygame.display.get_driver() != "dummy":
+            pygame.display.quit()
+            pygame.display.init()
+        if pygame.mixer.get_init() is not None:
+            pygame.mixer.quit()
+        pygame.mixer.init() # also when there was no audio device to start it with, sounds are still loaded
 
     def init_display(self):
+        if self.headless:
+            self.main_surface = pygame.display.set_mode(self.game_size)
+            self.output_size = self.output_width, self.output_height = self.game_size
+            self.screen = pygame.Surface(self.game_size)
+            return
         if Settings.windowed:
             outsize = self.game_size
             i = 1
@@ -889,21 +1802,39 @@ class GameControllerBase:
             flags = pygame.DOUBLEBUF
         else:
             flags = pygame.HWSURFACE | pygame.HWACCEL | pygame.ASYNCBLIT
+        self.screen_flags = flags
         main_flags = flags | (pygame.RESIZABLE if Settings.windowed else pygame.FULLSCREEN)
         if PYGAME_2 and not RASPBERRY_PI:
             self.main_surface = pygame.display.set_mode(outsize, main_flags, vsync=Settings.vsync)
         else:
             self.main_surface = pygame.display.set_mode(outsize, main_flags)
         self.output_size = self.output_width, self.output_height = self.main_surface.get_size()
-        self.screen = pygame.Surface(self.game_size, flags)
         if not Settings.enable_transparency:
             self.main_surface.set_alpha(None)
-            self.screen.set_alpha(None)
+        self.screen = self.create_screen()
+        if self.renderer is not None: # its canvases are screens too
+            self.renderer.stop()
+            self.renderer = ThreadedRenderer(self.create_screen)
+
+    def create_screen(self):
+        screen = pygame.Surface(self.game_size, self.screen_flags)
+        if not Settings.enable_transparency:
+            screen.set_alpha(None)
+        return screen
+
+    def sync_render(self): # call before changing a surface in place outside of drawing, the last frame may still be using it
+        if self.renderer is not None:
+            self.renderer.wait()
     
     def init(self):
-        self.init_display()
-        Assets.init()
-        Input.init()
+        FrameTimer.phases = self.frame_phases
+        with StartupTrace.span("init_display"):
+            self.init_display()
+        with StartupTrace.span("Assets.init"):
+            Assets.init()
+        with StartupTrace.span("Input.init"):
+            Input.init()
+        Input.sync_keys()
         Input.set_touch_handlers(
             press=self.handle_touch_event,
             release=self.handle_touch_event,
@@ -913,7 +1844,8 @@ class GameControllerBase:
         if RASPBERRY_PI:
             self.selection.disable_mouse()
             pygame.event.set_blocked(None)
-            pygame.event.set_allowed(pygame.QUIT)
+            pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP]) # keys are kept by Input.handle_event
+            if PYGAME_2: pygame.event.set_allowed([pygame.WINDOWFOCUSLOST, pygame.WINDOWFOCUSGAINED])
         else:
             self.selection.enable_mouse()
         self.hidden = False
@@ -942,6 +1874,25 @@ class GameControllerBase:
     def update_cursor_selection(self, just_pressed=False, touch_pos=None):
         pass
 
+    def handle_hotkey(self, key):
+        if key == K_F3:
+            FrameTimer.toggle_graph()
+        elif key == K_F4:
+            if FrameTimer.csv_file is None:
+                FrameTimer.start_csv(os.path.join(self.save_base, time.strftime("frame_timing_%Y%m%d_%H%M%S.csv")))
+            else:
+                FrameTimer.stop_csv()
+        elif key == K_F5:
+            if SamplingProfiler.running():
+                SamplingProfiler.stop()
+            else:
+                self.start_profile()
+
+    def start_profile(self): # profiles the thread that runs the game
+        SamplingProfiler.start(
+            os.path.join(self.save_base, time.strftime("profile_%Y%m%d_%H%M%S.folded")), self.profile_window
+        )
+
     def launch_selection(self):
         pass
 
@@ -957,6 +1908,13 @@ class GameControllerBase:
     def patch_background(self, rect):
         pass
 
+    def apply_to_screen(self, func, *args, **kwargs): # for calls that take the screen as an argument
+        if isinstance(self.screen, DisplayList):
+            return self.screen.apply(func, *args, **kwargs)
+        result = func(self.screen, *args, **kwargs)
+        if isinstance(result, pygame.Surface): self.screen = result # shaders return a new surface
+        return result
+
     def scale_rect(self, rect, xscale, yscale):
         new = rect.copy()
         new.w = new.w*xscale
@@ -969,52 +1927,123 @@ class GameControllerBase:
         if abs(target-value) < snap: return target
         return value + (target-value)/ease
 
+    def step(self): # advance the simulation by one tick
+        if self.ticks == self.profile_at:
+            self.start_profile()
+        self.update()
+        if self.buffer_touch_selection:
+            self.launch_selection()
+            self.selection.mouse_pressed = False
+            self.buffer_touch_selection = False
+        self.frame += 1
+        self.ticks += 1
+
+    def run_headless(self, steps=None): # step the simulation as fast as possible, without drawing
+        self.clock = pygame.time.Clock()
+        self.dt = 1/self.tick_rate
+        self.running = True
+        self.rects = []
+        self.prev_rects = []
+        while self.running and (steps is None or steps > 0) and not InputRecording.finished:
+            for event in pygame.event.get():
+                Input.handle_event(event)
+                if event.type == pygame.QUIT:
+                    self.running = False
+            if not self.running: break
+            with FrameTimer.phase("update"):
+                self.step()
+            FrameTimer.end_frame()
+            StartupTrace.mark_first_frame("first step")
+            if steps is not None: steps -= 1
+
     def mainloop(self):
+        if self.headless:
+            self.run_headless(self.headless_steps)
+            InputRecording.stop()
+            FrameTimer.stop_csv()
+            SamplingProfiler.stop()
+            Input.stop()
+            pygame.quit()
+            return
         self.clock = pygame.time.Clock()
         self.running = True
         self.rects = []
         self.prev_rects = []
+        self.renderer = ThreadedRenderer(self.create_screen) if Settings.threaded_render else None
 
+        step = 1/self.tick_rate
+        accumulator = step # always simulate before the first frame is drawn
         while self.running:
-            self.dt = self.clock.tick(60 if Settings.limit_fps else 0)/1000
+            self.dt = self.clock.tick(self.tick_rate if Settings.limit_fps else 0)/1000
+            frame_start = time.perf_counter()
+            accumulator += self.dt
             if self.hidden: continue
             
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    break
-                if event.type == pygame.VIDEORESIZE and Settings.windowed:
-                    self.output_size = self.output_width, self.output_height = event.dict["size"]
-                elif event.type == pygame.MOUSEMOTION:
-                    if RASPBERRY_PI:
-                        self.selection.disable_mouse()
-                    else:
-                        self.selection.enable_mouse()
-                        self.update_cursor_selection()
-                elif event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP) and not RASPBERRY_PI:
-                    if event.button == 1:
-                        if event.type == pygame.MOUSEBUTTONDOWN:
-                            self.selection.mouse_pressed = True
-                            self.update_cursor_selection(just_pressed=True)
+            with FrameTimer.phase("events"):
+                for event in pygame.event.get():
+                    Input.handle_event(event)
+                    if event.type == pygame.QUIT:
+                        self.running = False
+                        break
+                    if event.type == pygame.VIDEORESIZE and Settings.windowed:
+                        self.output_size = self.output_width, self.output_height = event.dict["size"]
+                    elif event.type == pygame.KEYDOWN:
+                        self.handle_hotkey(event.key)
+                    elif event.type == pygame.MOUSEMOTION:
+                        if RASPBERRY_PI:
+                            self.selection.disable_mouse()
                         else:
-                            self.launch_selection()
-                            self.selection.mouse_pressed = False
-            self.update()
-            if self.buffer_touch_selection:
-                self.launch_selection()
-                self.selection.mouse_pressed = False
-                self.buffer_touch_selection = False
-
-            self.draw()
-            self.draw_overlays()
+                            self.selection.enable_mouse()
+                            self.update_cursor_selection()
+                    elif event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP) and not RASPBERRY_PI:
+                        if event.button == 1:
+                            if event.type == pygame.MOUSEBUTTONDOWN:
+                                self.selection.mouse_pressed = True
+                                self.update_cursor_selection(just_pressed=True)
+                            else:
+                                self.launch_selection()
+                                self.selection.mouse_pressed = False
+            steps = 0
+            with FrameTimer.phase("update"):
+                while accumulator >= step and self.running:
+                    if steps == self.max_catch_up: # too far behind, slow down instead of spiralling
+                        accumulator = 0
+                        break
+                    self.step()
+                    accumulator -= step
+                    steps += 1
+
+            # drawing must not advance the simulation's rng
+            state = random.getstate() if InputRecording.mode is not None else None
+            if self.renderer is not None:
+                # drawing changes surfaces in place (alpha, the hud), so the last frame has to be done with them.
+                # it was rendered while this frame was simulated
+                with FrameTimer.phase("scale"):
+                    frame = self.renderer.wait()
+                self.screen = DisplayList(self.game_size, self.renderer)
+            with FrameTimer.phase("draw"):
+                self.draw()
+            with FrameTimer.phase("overlays"):
+                self.draw_overlays()
+                FrameTimer.draw(self.screen)
+            if state is not None: random.setstate(state)
             if self.hidden: continue
             try:
-                if self.output_size == self.game_size:
-                    self.main_surface.blit(self.screen, (0, 0))
-                else:
-                    self.main_surface.blit(pygame.transform.scale(self.screen, self.output_size), (0, 0))
+                with FrameTimer.phase("scale"): # includes waiting for the previous frame when threaded
+                    if self.renderer is not None:
+                        self.renderer.submit(self.screen, self.output_size)
+                        if frame is None: continue # nothing rendered yet
+                        self.main_surface.blit(frame, (0, 0))
+                    elif self.output_size == self.game_size:
+                        self.main_surface.blit(self.screen, (0, 0))
+                    else:
+                        self.main_surface.blit(pygame.transform.scale(self.screen, self.output_size), (0, 0))
             except pygame.error: continue
-            pygame.display.update()
+            QualityGovernor.frame(time.perf_counter()-frame_start, step)
+            with FrameTimer.phase("display"):
+                pygame.display.update()
+            FrameTimer.end_frame()
+            StartupTrace.mark_first_frame()
             # self.rects = list(filter(lambda rect: rect is not None, self.rects))
             # xscale, yscale = self.output_width/self.game_width, self.output_height/self.game_height
             # inflated = [self.scale_rect(rect, xscale, yscale).inflate(3, 3) for rect in self.rects+self.prev_rects]
@@ -1022,8 +2051,13 @@ class GameControllerBase:
             # for rect in self.rects:
             #     self.patch_background(rect)
             self.prev_rects = self.rects[:]
-            self.frame += 1
 
+        if self.renderer is not None:
+            self.renderer.stop()
+            self.renderer = None
+        InputRecording.stop()
+        FrameTimer.stop_csv()
+        SamplingProfiler.stop()
         Input.stop()
         pygame.quit()
     
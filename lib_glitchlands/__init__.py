@@ -119,6 +119,11 @@ class LevelData:
         self.glitch_zones = self.json_data.get("glitch_zones", [])
 
 class Background:
+    # every entry is a full plane of about 2 MB, so both are bounded by frame count
+    planes = Cache(8) # filled image per background num
+    transitions = Cache(11) # filled image per (prev_num, num, transition_dir, transition_timer), one whole transition
+    glitch_pool = VariantPool(3, 4) # glitch images per background num
+
     def __init__(self, gc, num=0):
         self.gc = gc
         self.num = num
@@ -133,33 +138,40 @@ class Background:
         self.generate_image()
         self.still_image = None
 
+    def fill_plane(self, tile):
+        return Assets.tile_surface_fill(tile, self.gc.game_width+self.tilew, self.gc.game_height+self.tilew)
+
+    def generate_transition_plane(self):
+        prev_tile = self.gc.assets.backgrounds[self.prev_num].copy()
+        transformed = pygame.transform.rotozoom(
+            self.tile.convert_alpha(),
+            self.transition_timer/9*self.transition_dir,
+            min((12-self.transition_timer)/9, 1)
+        )
+        prev_tile.blit(transformed, transformed.get_rect(center=(self.tilew//2, self.tileh//2)))
+        return self.fill_plane(prev_tile)
+
     def generate_image(self):
         self.tile = self.gc.assets.backgrounds[self.num]
         self.tilew, self.tileh = self.tile.get_size()
         if self.transition_timer > 0:
-            prev_tile = self.gc.assets.backgrounds[self.prev_num].copy()
-            transformed = pygame.transform.rotozoom(
-                self.tile.convert_alpha(),
-                self.transition_timer/9*self.transition_dir,
-                min((12-self.transition_timer)/9, 1)
-            )
-            prev_tile.blit(transformed, transformed.get_rect(center=(self.tilew//2, self.tileh//2)))
+            key = (self.prev_num, self.num, self.transition_dir, self.transition_timer)
+            self.image = Background.transitions.get(key, self.generate_transition_plane)
         else:
-            prev_tile = None
-        self.image = Assets.tile_surface_fill(
-            prev_tile if prev_tile is not None else self.tile,
-            self.gc.game_width+self.tilew,
-            self.gc.game_height+self.tilew
-        )
-        if self.transition_timer == 0: self.generate_glitch_image()
+            self.image = Background.planes.get(self.num, lambda: self.fill_plane(self.tile))
+        if self.transition_timer == 0: self.generate_glitch_image(grow=False)
 
-    def generate_glitch_image(self):
-        self.glitch_image = self.image.copy()
-        self.glitch_image.blit(
+    def create_glitch_image(self):
+        im = self.image.copy()
+        im.blit(
             random.choice(self.gc.assets.backgrounds),
             (random.randint(0, self.gc.game_width//self.tilew)*self.tilew,
              random.randint(0, self.gc.game_height//self.tileh)*self.tileh)
             )
+        return im
+
+    def generate_glitch_image(self, grow=True):
+        self.glitch_image = Background.glitch_pool.get_variant(self.num, self.create_glitch_image, grow)
         
     def generate_pause_image(self):
         self.still_image = self.gc.screen.copy()
@@ -214,12 +226,14 @@ class Background:
     def draw(self):
         if self.use_still_image:
             return self.gc.screen.blit(self.still_image, (0, 0))
-        glitch = self.transition_timer == 0 and \
+        glitch = self.transition_timer == 0 and QualityGovernor.allows("glitches") and \
             self.gc.glitch_chance >= 0 and random.randint(0, self.gc.glitch_chance)//20 == 0
         return self.gc.screen.blit(self.glitch_image if glitch else self.image, (-self.tilew+self.xofs, -self.tileh+self.yofs))
 
 
 class FullscreenOverlay:
+    images = Cache(8) # shared overlay images per (color, source surface, shake, alpha, size), never drawn at once
+
     def __init__(self, gc, fade=(0, 0, 0), color=None, surface=None, shake=0):
         self.gc = gc
         self.color = color
@@ -239,14 +253,25 @@ class FullscreenOverlay:
         return self.timer >= self.fade_in+self.hold/2
     
     def generate_overlay(self, alpha=255):
-        self.image = Assets.sized_surface((self.gc.game_width+self.shake*2, self.gc.game_height+self.shake*2))
+        color = tuple(self.color) if self.color is not None else None
+        key = (color, self.surface, self.shake, alpha, self.gc.game_size)
+        self.image = FullscreenOverlay.images.get(key, lambda: self.create_overlay(alpha))
+
+    def create_overlay(self, alpha=255):
+        image = Assets.sized_surface((self.gc.game_width+self.shake*2, self.gc.game_height+self.shake*2))
+        opaque = False
         if self.color is not None:
             if alpha < 255 and type(self.color) in (tuple, list) and len(self.color) == 3:
-                self.image.fill(tuple(self.color)+(alpha,))
+                fill = tuple(self.color)+(alpha,)
             else:
-                self.image.fill(self.color)
+                fill = self.color
+            image.fill(fill)
+            opaque = pygame.Color(fill).a == 255
         if self.surface is not None:
-            self.image.blit(pygame.transform.scale(self.surface, self.gc.game_size), (self.shake, self.shake))
+            image.blit(pygame.transform.scale(self.surface, self.gc.game_size), (self.shake, self.shake))
+        if opaque: # faded with surface alpha, much cheaper to blit than per pixel alpha
+            image = image.convert()
+        return image
     
     def update(self):
         self.timer += 1
@@ -259,10 +284,12 @@ class FullscreenOverlay:
             opacity = 1
         else: # fade in
             opacity = self.timer/self.fade_in
-        if Settings.enable_transparency:
+        if QualityGovernor.allows("transparency"):
             self.image.set_alpha(opacity*255)
         elif opacity < .75:
             return
+        else:
+            self.image.set_alpha(None) # may still be faded from its last use
         if self.shake != 0:
             pos = (random.randint(-self.shake*2, 0), random.randint(-self.shake*2, 0))
         else:
@@ -270,6 +297,258 @@ class FullscreenOverlay:
         return self.gc.screen.blit(self.image, pos)
 
 
+class HudOverlay: # fps counter, speedrun timer and splits in the top left corner
+    def __init__(self, gc):
+        self.gc = gc
+        self.labels = {} # (text, rendered) per label, only re-rendered when the text changes
+        self.split_rows = Cache(16) # (rendered name, rendered time) per (name, formatted time)
+        self.images = [None, None] # alternated, the render thread may still be drawing the last one
+        self.image = None
+        self.key = None
+
+    def render_label(self, name, text):
+        if name not in self.labels or self.labels[name][0] != text:
+            self.labels[name] = (text, Assets.debug_font.render(text, False, WHITE))
+        return self.labels[name][1]
+
+    def render_split(self, name, formatted):
+        return self.split_rows.get((name, formatted), lambda: (
+            Assets.debug_font.render(name, False, WHITE),
+            Assets.debug_font.render(formatted, False, WHITE)
+        ))
+
+    def update(self):
+        fps, elapsed, splits = None, None, ()
+        if Settings.show_fps:
+            fps = str(round(self.gc.clock.get_fps(), 2))
+        if GlobalSave.speedrun_mode and self.gc.in_game:
+            elapsed = self.gc.format_elapsed(self.gc.get_elapsed_time())
+            splits = tuple((split[0], split[2]) for split in self.gc.splits[-5:])
+        key = (fps, elapsed, splits, self.gc.in_game)
+        if key == self.key: return
+        self.key = key
+        rows = [] # [(rendered, x)] per 16px row
+        if fps is not None:
+            rows.append([(self.render_label("fps", fps), 3)])
+        if elapsed is not None:
+            rows.append([(self.render_label("elapsed", elapsed), 3)])
+            for split in splits:
+                name, time_ = self.render_split(*split)
+                rows.append([(name, 3), (time_, 180-time_.get_width()-3)])
+        if len(rows) == 0:
+            self.image = None
+            return
+        size = (
+            max([180]+[x+im.get_width() for row in rows for im, x in row]),
+            max([len(rows)*16]+[16*i+2+im.get_height() for i, row in enumerate(rows) for im, x in row])
+        )
+        self.images.reverse()
+        if self.images[0] is None or self.images[0].get_size() != size:
+            self.images[0] = Assets.sized_surface(size)
+        else:
+            self.images[0].fill((0, 0, 0, 0))
+        self.image = self.images[0]
+        if len(rows) > 1 and self.gc.in_game:
+            self.image.fill((0, 0, 0, 128), (0, 0, 180, len(rows)*16))
+        self.image.blits([(im, (x, 16*i+2)) for i, row in enumerate(rows) for im, x in row], doreturn=False)
+
+    def draw(self):
+        self.update()
+        if self.image is None: return
+        return self.gc.screen.blit(self.image, (0, 0))
+
+
+class MapCanvas: # persistent map surfaces, only the tiles affected by a newly visited level are redrawn
+    level_size = (100, 60)
+    color_key = [
+        (170, 186, 206), # light
+        (213, 177, 149),
+        (194, 194, 194),
+        (147, 197, 150),
+        (209, 169, 191),
+        (181, 169, 201),
+        (213, 204, 158),
+        (85, 69, 49), # dark
+        (42, 78, 106),
+        (61, 61, 61),
+        (108, 58, 105),
+        (46, 86, 64),
+        (74, 86, 54),
+        (42, 51, 97),
+        (255, 0, 255), # missing
+        (136, 0, 136),
+    ]
+    icon_key = {"upgrade": 2, "lever": 3, "crystal": 5, "teleporter": 7, "virus": 8}
+
+    def __init__(self, gc):
+        self.gc = gc
+        self.tiles = None # (tile data, (left, top, right, bottom)) per level pos, built when the map is first opened
+        self.linked = {} # level positions whose borders depend on whether a level pos is visited
+        self.border_rects = [] # (border, side, rect relative to the tile)
+        self.worlds = [] # [surface, map rect, revealed tile count] per world
+        self.overlay = None # teleporter lines and level icons
+        self.overlay_rect = None
+        self.overlay_key = None
+        self.revealed = set()
+        self.random_tiles = set() # revealed tiles with a random color, re-rolled every time the map is opened
+        self.current = None # shown while the map is open, even if it isn't revealed yet
+
+    @property
+    def total_count(self):
+        return len(self.tiles)
+
+    @property
+    def revealed_count(self):
+        return sum(world[2] for world in self.worlds)+self.current_is_extra
+
+    @property
+    def current_is_extra(self): # shown without being revealed
+        return self.current is not None and self.current not in self.revealed and self.current in self.tiles
+
+    def is_shown(self, pos):
+        return pos in self.revealed or pos == self.current
+
+    def get_center(self, pos):
+        world_data = self.gc.assets.map["data"][pos[0]]
+        return (
+            (pos[1]+world_data.get("xofs", 0))*self.level_size[0],
+            (pos[2]+world_data.get("yofs", 0))*self.level_size[1]
+        )
+
+    def build(self):
+        w, h = self.level_size
+        bw, bh = math.ceil((w-4)/3), math.ceil((h-4)/3)
+        self.border_rects = [
+            (0, 0, (0, h-2-bh, 3, bh)), (1, 0, (0, h//2-bh//2, 3, bh)), (2, 0, (0, 2, 3, bh)),
+            (3, 1, (2, 0, bw, 3)), (4, 1, (w//2-bw//2, 0, bw, 3)), (5, 1, (w-2-bw, 0, bw, 3)),
+            (6, 2, (w-3, 2, 3, bh)), (7, 2, (w-3, h//2-bh//2, 3, bh)), (8, 2, (w-3, h-2-bh, 3, bh)),
+            (9, 3, (w-2-bw, h-3, bw, 3)), (10, 3, (w//2-bw//2, h-3, bw, 3)), (11, 3, (2, h-3, bw, 3)),
+        ]
+        self.tiles = {}
+        for world, world_data in enumerate(self.gc.assets.map.get("data")):
+            rect = None
+            for pos_string, tile_data in world_data.get("levels", {}).items():
+                pos = (world,) + tuple(int(n) for n in pos_string.split(","))
+                neighbours = (
+                    tuple(tile_data["left"]) if "left" in tile_data else (pos[0], pos[1]-1, pos[2]),
+                    tuple(tile_data["top"]) if "top" in tile_data else (pos[0], pos[1], pos[2]-1),
+                    tuple(tile_data["right"]) if "right" in tile_data else (pos[0], pos[1]+1, pos[2]),
+                    tuple(tile_data["bottom"]) if "bottom" in tile_data else (pos[0], pos[1], pos[2]+1),
+                )
+                self.tiles[pos] = (tile_data, neighbours)
+                for other in neighbours:
+                    self.linked.setdefault(other, []).append(pos)
+                cx, cy = self.get_center(pos)
+                tile_rect = pygame.Rect(cx-w//2, cy-h//2, w, h)
+                rect = tile_rect if rect is None else rect.union(tile_rect)
+            self.worlds.append([None if rect is None else Assets.sized_surface(rect.size), rect, 0])
+        rects = [world[1] for world in self.worlds if world[1] is not None]
+        self.overlay_rect = rects[0].unionall(rects[1:]).inflate(64, 64) # icons may overhang their tile
+        self.overlay = Assets.sized_surface(self.overlay_rect.size)
+        self.reveal(*self.gc.visited_levels)
+
+    def reveal(self, *positions):
+        if self.tiles is None: return # everything visited so far is drawn when the map is first opened
+        self.gc.sync_render() # tiles are redrawn in place
+        for pos in positions:
+            if pos in self.revealed: continue
+            self.revealed.add(pos)
+            if pos not in self.tiles: continue
+            self.worlds[pos[0]][2] += 1
+            if self.tiles[pos][0].get("color", 2) < 0:
+                self.random_tiles.add(pos)
+            self.draw_tile(pos)
+            for other in self.linked.get(pos, ()): # open up the borders facing this level
+                if other != pos and other in self.revealed:
+                    self.draw_tile(other)
+
+    def draw_tile(self, pos):
+        tile_data, neighbours = self.tiles[pos]
+        surface, rect, _ = self.worlds[pos[0]]
+        color = tile_data.get("color", 2)
+        if pos == self.current: color = self.gc.background.num
+        elif color == -1: color = random.randint(0, 6)
+        elif color == -2: color = random.randint(7, 13)
+        elif color == -3: color = random.randint(0, 13)
+        fill = self.color_key[color]
+        if color in (7, 8, 9, 10, 11, 12, 13, 15):
+            stroke = tuple(int(n*1.3) for n in fill)
+        else:
+            stroke = tuple(int(n*0.8) for n in fill)
+        w, h = self.level_size
+        cx, cy = self.get_center(pos)
+        x, y = cx-w//2-rect.x, cy-h//2-rect.y
+        surface.fill(fill, (x, y, w, h))
+        pygame.draw.rect(surface, stroke, (x, y, w, h), 2)
+        borders = tile_data.get("borders", [])
+        for border, side, (bx, by, bw, bh) in self.border_rects:
+            if border in borders and self.is_shown(neighbours[side]):
+                surface.fill(fill, (x+bx, y+by, bw, bh))
+
+    def clear_tile(self, pos):
+        surface, rect, _ = self.worlds[pos[0]]
+        cx, cy = self.get_center(pos)
+        w, h = self.level_size
+        surface.fill((0, 0, 0, 0), (cx-w//2-rect.x, cy-h//2-rect.y, w, h))
+
+    def draw_overlay(self):
+        self.overlay.fill((0, 0, 0, 0))
+        ox, oy = self.overlay_rect.topleft
+        w, h = self.level_size
+        line_color = (255, 255, 255, 64) if QualityGovernor.allows("transparency") else WHITE
+        npcs = {npc[1:] for npc in self.gc.visited_npcs}
+        icons = [] # (num, x, y)
+        for pos, (tile_data, _) in self.tiles.items():
+            if not self.is_shown(pos) or not tile_data.get("icon_name"): continue
+            if tile_data.get("icon_hide_level") is not None and self.is_shown(tuple(tile_data["icon_hide_level"])): continue
+            cx, cy = self.get_center(pos)
+            icon_pos = tile_data.get("icon_pos", [0, 0])
+            icon_x, icon_y = cx+icon_pos[0]*(w//3), cy+icon_pos[1]*(h//4)
+            num = self.icon_key[tile_data["icon_name"]]
+            if tile_data["icon_name"] == "crystal" and pos in npcs: num += 1
+            icons.append((num, icon_x, icon_y))
+            if tile_data.get("warp_target"):
+                target_pos = tuple(tile_data["warp_target"])
+                if not self.is_shown(target_pos): continue
+                target_cx, target_cy = self.get_center(target_pos)
+                target_icon_pos = self.tiles.get(target_pos, ({}, None))[0].get("icon_pos", [0, 0])
+                pygame.draw.line(self.overlay, line_color, (icon_x-ox, icon_y-oy), (
+                    target_cx+target_icon_pos[0]*(w//3)-ox,
+                    target_cy+target_icon_pos[1]*(h//4)-oy
+                ), 3)
+        blits = []
+        for num, x, y in icons[::-1]:
+            icon = self.gc.assets.map["icons"][num]
+            blits.append((icon, (x-ox-icon.get_width()//2, y-oy-icon.get_height()//2)))
+        self.overlay.blits(blits, doreturn=False)
+
+    def update(self): # called when the map is opened
+        self.gc.sync_render() # tiles are redrawn in place
+        if self.tiles is None: self.build()
+        prev, self.current = self.current, self.gc.level.level_pos
+        redraw = {prev, self.current} | self.random_tiles
+        if prev != self.current: # borders facing a level that's only shown while it's current open and close
+            for pos in (prev, self.current):
+                if pos not in self.revealed: redraw.update(self.linked.get(pos, ()))
+        for pos in redraw:
+            if pos not in self.tiles: continue
+            if self.is_shown(pos): self.draw_tile(pos)
+            elif pos == prev: self.clear_tile(pos) # was only shown while it was current
+        key = (
+            len(self.revealed), len(self.gc.visited_npcs), QualityGovernor.allows("transparency"),
+            self.current if self.current_is_extra else None
+        )
+        if key != self.overlay_key:
+            self.overlay_key = key
+            self.draw_overlay()
+
+    def get_layers(self): # (surface, map position, hide_ok)
+        extra = self.current[0] if self.current_is_extra else None
+        layers = [(surface, rect.topleft, False) for i, (surface, rect, count) in enumerate(self.worlds) if count > 0 or i == extra]
+        layers.append((self.overlay, self.overlay_rect.topleft, True))
+        return layers
+
+
 class Checkpoint:
     def __init__(self, level_pos, left=None, right=None, top=None, bottom=None, centerx=None, facing_right=True):
         self.level_pos = level_pos
@@ -37,7 +37,12 @@ def create_object(gc, level, config, **kwargs):
         OBJTYPE_VIRUSBOSS: VirusBoss,
     }[typ](*args, **kwargs)
 
+tip_images = Cache(32) # tip images per (text, icon_nums), shared so copy before modifying
+
 def generate_tip_image(gc, text, *icon_nums):
+    return tip_images.get((text, icon_nums), lambda: generate_tip_image_uncached(gc, text, *icon_nums))
+
+def generate_tip_image_uncached(gc, text, *icon_nums):
     icons = gc.assets.ui["key_icons"]
     text_image = gc.assets.font_outlined.render(text)
     if len(icon_nums) == 0:
@@ -117,7 +122,7 @@ class Object(pygame.sprite.Sprite):
     def update(self):
         pass
     def blit_rect(self, rect, color, width=0, xofs=0, yofs=0):
-        return pygame.draw.rect(self.gc.screen, color, (rect.x-self.gc.xscroll+xofs, rect.y+yofs, rect.w, rect.h), width)
+        return self.gc.apply_to_screen(pygame.draw.rect, color, (rect.x-self.gc.xscroll+xofs, rect.y+yofs, rect.w, rect.h), width)
     def blit_image(self, im, rect, xofs=0, yofs=0, area=None):
         return self.gc.screen.blit(im, (rect.x-self.gc.xscroll+xofs, rect.y+yofs), area)
     def draw_hitbox(self):
@@ -145,6 +150,8 @@ class Activateable(Object):
         self.activated = False
 
 class Block(Object):
+    glitch_pool = VariantPool(4, 256, 4*1024*1024) # glitch images per (type, style, num, xrep, yrep, fake), at most 4M pixels (16 MB) in total
+
     def update_config(self, config):
         super().update_config(config)
         self.xrep = config.get("xrep", 1)
@@ -178,7 +185,7 @@ class Block(Object):
             self.frames = [Assets.tile_surface_repetition(frame, self.xrep, self.yrep, alpha=self.type <= OBJTYPE_SEMISOLID) \
                            for frame in self.frames]
             self.rect = pygame.Rect(self.x, self.y, self.image.get_width(), self.image.get_height())
-            self.generate_glitch_image()
+            self.generate_glitch_image(grow=False)
         else: # invisible block
             self.image = None
             self.rect = pygame.Rect(self.x, self.y, self.tilew*self.xrep, self.tileh*self.yrep)
@@ -211,26 +218,30 @@ class Block(Object):
             self.collides = COLLISION_NONE
         if self.fake:
             self.collides = COLLISION_NONE
-    def generate_glitch_image(self):
-        if self.image is None or Settings.low_detail:
-            self.glitch_image = None
-            return
-        self.glitch_image = self.image.copy()
+    def create_glitch_image(self):
+        im = self.image.copy()
         terrain = self.gc.assets.terrain[-self.type]
         if len(terrain) > 1:
             style = self.style
             while style == self.style: style = random.randint(0, len(terrain)-1)
-            self.glitch_image.blit(
+            im.blit(
                 terrain[style][self.num],
                 (random.randint(0, self.xrep-1)*self.tilew, random.randint(0, self.yrep-1)*self.tileh)
                 )
         else:
             for _ in range(2 if self.fake else 1):
                 pygame.draw.rect(
-                    self.glitch_image,
+                    im,
                     (0, 0, 0, 0),
                     (random.randint(0, self.xrep-1)*self.tilew, random.randint(0, self.yrep-1)*self.tileh, self.tilew, self.tileh)
                     )
+        return im
+    def generate_glitch_image(self, grow=True):
+        if self.image is None or not QualityGovernor.allows("glitches"):
+            self.glitch_image = None
+            return
+        key = (self.type, self.style, self.num, self.xrep, self.yrep, self.fake)
+        self.glitch_image = Block.glitch_pool.get_variant(key, self.create_glitch_image, grow)
     def collides_horizontal(self, entity, dx=0):
         if self.type == OBJTYPE_SEMISOLID: return False
         return self.hitbox.colliderect(entity.hitbox)
@@ -247,7 +258,7 @@ class Block(Object):
         if self.image is None or (self.anim_duration > 0 and not self.loaded): return
         if self.anim_frame//self.anim_delay > self.anim_duration-1: im = self.image
         else: im = self.frames[self.anim_frame//self.anim_delay+self.anim_duration*self.num]
-        if self.gc.glitch_chance >= 0 and self.glitch_image is not None:
+        if self.gc.glitch_chance >= 0 and self.glitch_image is not None and QualityGovernor.allows("glitches"):
             glitch_reduction = self.xrep*self.yrep
             if self.fake: glitch_reduction *= 20
             if random.randint(0, self.gc.glitch_chance)//glitch_reduction == 0:
@@ -604,6 +615,8 @@ class Crusher(Object):
         return self.blit_image(self.frames.get(x=frame, y=self.num), self.rect)
 
 class GlitchZone(Object):
+    frame_sets = Cache(64) # frames per (xrep, yrep, color, enable_transparency)
+
     def update_config(self, config):
         super().update_config(config)
         self.xrep = config.get("xrep", 1)
@@ -618,7 +631,10 @@ class GlitchZone(Object):
         self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
         self.update_hitbox()
         self.color = [RED, GREEN, BLUE, WHITE, BLACK][self.num]
-        self.frames = [self.generate_image() for _ in range(16)]
+        self.frames = GlitchZone.frame_sets.get(
+            (self.xrep, self.yrep, self.color, QualityGovernor.allows("transparency")),
+            lambda: [self.generate_image() for _ in range(16)]
+        )
         self.anim_delay = 4
         self.tip_image = generate_tip_image(self.gc, "Warp", 1)
         self.show_tip = False
@@ -642,22 +658,15 @@ class GlitchZone(Object):
                 self.warp = self.config.get("warp", None)
             elif self.num == 2:
                 self.physics = self.config.get("physics", {})
-    def transparent_rect(self, width, height, opacity):
-        im = Assets.sized_surface(width, height)
-        im.fill(self.color+(opacity*255,))
-        return im
     def generate_image(self):
         im = Assets.sized_surface(self.width, self.height)
         for x in range(self.xrep):
             for y in range(self.yrep):
                 opacity = random.random()
-                if not Settings.enable_transparency:
+                if not QualityGovernor.allows("transparency"):
                     if opacity < .5: continue
                     opacity = 1
-                im.blit(
-                    self.transparent_rect(self.tilew, self.tileh, opacity),
-                    (x*self.tilew,  y*self.tileh)
-                )
+                im.fill(self.color+(opacity*255,), (x*self.tilew, y*self.tileh, self.tilew, self.tileh))
         return im
     def pre_warp(self, player):
         self.show_tip = False
@@ -699,11 +708,13 @@ class GlitchZone(Object):
         if self.appear_delay is not None and self.anim_frame <= self.appear_delay:
             return
         im = self.frames[self.anim_frame//self.anim_delay%len(self.frames)]
+        alpha = 255
         if self.appear_delay is not None:
             if self.anim_frame <= self.appear_delay+4:
-                im.set_alpha((self.anim_frame-self.appear_delay)/4*255)
+                alpha = (self.anim_frame-self.appear_delay)/4*255
             elif self.disappear_delay is not None and self.anim_frame > self.appear_delay+self.disappear_delay-4:
-                im.set_alpha((self.appear_delay+self.disappear_delay-4+self.anim_frame)/4*255)
+                alpha = (self.appear_delay+self.disappear_delay-4+self.anim_frame)/4*255
+        im.set_alpha(alpha) # frames are shared with other zones of the same shape, so every draw sets its own
         rect = self.blit_image(im, self.rect)
         if self.tip_yofs is not None and (self.show_tip or self.tip_frame < 5):
             tip = self.tip_image.copy()
@@ -545,7 +545,7 @@ class Player(pygame.sprite.Sprite):
     
     def draw_hitbox(self):
         self.update_hitbox()
-        return pygame.draw.rect(self.gc.screen, CYAN, (self.hitbox.x-self.gc.xscroll, self.hitbox.y, self.hitbox.w, self.hitbox.h), 1)
+        return self.gc.apply_to_screen(pygame.draw.rect, CYAN, (self.hitbox.x-self.gc.xscroll, self.hitbox.y, self.hitbox.w, self.hitbox.h), 1)
         
     def draw(self):
         sheet = self.gc.assets.player[self.anim]
@@ -591,7 +591,7 @@ class PlayerAttack:
             self.rect.bottom < 0 or self.rect.top > self.gc.game_height:
             self.self_destruct = True
     def blit_rect(self, rect, color, width=0, xofs=0, yofs=0):
-        return pygame.draw.rect(self.gc.screen, color, (rect.x-self.gc.xscroll+xofs, rect.y+yofs, rect.w, rect.h), width)
+        return self.gc.apply_to_screen(pygame.draw.rect, color, (rect.x-self.gc.xscroll+xofs, rect.y+yofs, rect.w, rect.h), width)
     def blit_image(self, im, rect, xofs=0, yofs=0, area=None):
         return self.gc.screen.blit(im, (rect.x-self.gc.xscroll+xofs, rect.y+yofs), area)
     def draw_hitbox(self):
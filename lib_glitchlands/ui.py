@@ -28,7 +28,6 @@ class Graphic(pygame.sprite.Sprite):
         if cx is None: cx = gc.game_width//2
         if cy is None: cy = gc.game_height//2
         self.rect = pygame.Rect(cx-self.width//2, cy-self.height//2, self.width, self.height)
-        self.xofs, self.yofs = 0, 0
         self.anim_frame = 0
         self.anim_delay = anim_delay
         self.fixed = False # has fixed position on scrolling menu (such as map ui)
@@ -38,11 +37,8 @@ class Graphic(pygame.sprite.Sprite):
         self.width, self.height = self.frames[0].get_size()
     def update(self):
         self.anim_frame += 1
-    @property
-    def adjusted_rect(self):
-        return pygame.Rect(self.rect.x+self.xofs, self.rect.y+self.yofs, self.rect.w, self.rect.h)
-    def draw(self):
-        return self.gc.screen.blit(self.frames[(self.anim_frame//self.anim_delay)%len(self.frames)], self.adjusted_rect)
+    def draw(self, xofs=0, yofs=0): # offset by the scroll of the layer it is drawn in
+        return self.gc.screen.blit(self.frames[(self.anim_frame//self.anim_delay)%len(self.frames)], (self.rect.x+xofs, self.rect.y+yofs))
 
 class Button(Graphic):
     def __init__(self, gc, frames, indexes=None, cx=None, cy=None, hit_inflate=(4, 4)):
@@ -54,22 +50,15 @@ class Button(Graphic):
     def update_frames(self, frames):
         super().update_frames(frames)
         self.height += 2
-        self.unpressed_frames, self.pressed_frames = [], []
-        for frame in self.frames:
-            im = Assets.sized_surface(self.width, self.height)
-            im.blit(frame, (0, 2))
-            im.blit(frame, (0, 0))
-            self.unpressed_frames.append(im)
-            im = Assets.sized_surface(self.width, self.height)
-            im.blit(frame, (0, 2))
-            im.fill((32, 32, 32), special_flags=pygame.BLEND_RGB_ADD)
-            self.pressed_frames.append(im)
+        faces = [self.gc.assets.get_button_faces(frame) for frame in self.frames]
+        self.unpressed_frames = [face[0] for face in faces]
+        self.pressed_frames = [face[1] for face in faces]
     def update(self):
         return
-    def draw(self):
+    def draw(self, xofs=0, yofs=0):
         return self.gc.screen.blit(
             (self.pressed_frames if self.gc.selection.idx in self.indexes else self.unpressed_frames)[self.anim_frame],
-            self.adjusted_rect
+            (self.rect.x+xofs, self.rect.y+yofs)
         )
 
 class Slider(Button):
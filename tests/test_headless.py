@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import pygame
+
+import glitchlands
+
+
+class HeadlessTest(unittest.TestCase):
+    def test_enable_headless_without_mixer(self):
+        pygame.mixer.quit()
+        glitchlands.GameController.enable_headless()
+        self.assertIsNotNone(pygame.mixer.get_init())
+
+        with tempfile.TemporaryDirectory() as save_base:
+            gc = glitchlands.GameController()
+            gc.save_base = save_base
+            gc.init()
+            self.assertTrue(gc.headless)
+
+
+if __name__ == "__main__":
+    unittest.main()